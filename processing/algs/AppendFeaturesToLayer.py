@@ -16,25 +16,34 @@
  *                                                                         *
  ***************************************************************************/
 """
-from qgis.PyQt.QtCore import (QVariant,
-                              QCoreApplication)
+from qgis.PyQt.QtCore import QCoreApplication
 
 from qgis.core import (edit,
                        QgsEditError,
-                       QgsGeometry,
                        QgsWkbTypes,
                        QgsProcessing,
                        QgsProcessingAlgorithm,
                        QgsProcessingParameterEnum,
                        QgsProcessingParameterFeatureSource,
                        QgsProcessingParameterField,
+                       QgsProcessingParameterNumber,
                        QgsProcessingParameterVectorLayer,
                        QgsProcessingOutputVectorLayer,
                        QgsProject,
                        QgsVectorLayerUtils,
                        QgsVectorDataProvider,
                        QgsProcessingOutputNumber,
-                       QgsFeatureRequest)
+                       QgsFeatureRequest,
+                       QgsFields,
+                       QgsDataSourceUri,
+                       QgsExpression)
+
+from array import array
+
+from .bulk_loader import CopyWriter
+from .geometry_stage import AvoidIntersectionsIndex, GeometryStage
+from .key_index import KeyIndex, key_array, key_converter
+from .schema_introspection import BASE_TABLE_KINDS, pg_connect_info, quote_ident, quote_table
 
 
 class AppendFeaturesToLayer(QgsProcessingAlgorithm):
@@ -44,6 +53,8 @@ class AppendFeaturesToLayer(QgsProcessingAlgorithm):
     OUTPUT = 'TARGET_LAYER'
     OUTPUT_FIELD = 'TARGET_FIELD'
     ACTION_ON_DUPLICATE = 'ACTION_ON_DUPLICATE'
+    CHUNK_SIZE = 'CHUNK_SIZE'
+    WORKERS = 'WORKERS'
 
     APPENDED_COUNT = 'APPENDED_COUNT'
     UPDATED_COUNT = 'UPDATED_COUNT'
@@ -56,6 +67,13 @@ class AppendFeaturesToLayer(QgsProcessingAlgorithm):
     SKIP_FEATURE = 1
     UPDATE_EXISTING_FEATURE = 2
 
+    # Duplicates are looked up with IN filters when the target has this many times the source features
+    LOOKUP_RATIO = 10
+    # Source values sent to the provider in each IN filter, and source features prepared at a time
+    LOOKUP_BATCH_SIZE = 1000
+    # Target features changed by each call to the provider, when updates bypass the edit buffer
+    UPDATE_BATCH_SIZE = 10000
+
     def tr(self, string):
         """
         Returns a translatable string with the self.tr() function.
@@ -84,7 +102,10 @@ class AppendFeaturesToLayer(QgsProcessingAlgorithm):
         return self.tr("AppendFeaturesToLayer", "This algorithm copies features from a source layer into a target layer.\n\n"
                                           "Field mapping is handled automatically. Fields that are in both source and target layers are copied. Fields that are only found in source are not copied to target layer.\n\n"
                                           "Geometry conversion is done automatically, if required by the target layer. For instance, single-part geometries are converted to multi-part if target layer handles multi-geometries; polygons are converted to lines if target layer stores lines; among others.\n\n"
-                                          "This algorithm allows you to choose a field in source and target layers to compare and detect duplicates. It has 3 modes of operation: 1) APPEND feature, regardless of duplicates; 2) SKIP feature if duplicate is found; or 3) UPDATE the feature in target layer with attributes from the feature in the source layer.")
+                                          "This algorithm allows you to choose a field in source and target layers to compare and detect duplicates. It has 3 modes of operation: 1) APPEND feature, regardless of duplicates; 2) SKIP feature if duplicate is found; or 3) UPDATE the feature in target layer with attributes from the feature in the source layer.\n\n"
+                                          "With a chunk size, features are written and committed to the target layer every chunk of features, so that only one chunk is kept in memory. Otherwise, all features are written in a single edit session.\n\n"
+                                          "The geometries of each chunk of features can be converted by parallel workers. The layers to avoid intersections with are read once into a spatial index.\n\n"
+                                          "When no action on duplicates is chosen and the target is a PostGIS table, features are appended with COPY, straight into the table. Source values of the primary key are kept, NULL ones get its default value.")
 
     def initAlgorithm(self, config=None):
         self.addParameter(QgsProcessingParameterFeatureSource(self.INPUT,
@@ -109,6 +130,18 @@ class AppendFeaturesToLayer(QgsProcessingAlgorithm):
                                                      False,
                                                      self.NO_ACTION_TEXT,
                                                      optional=False))
+        self.addParameter(QgsProcessingParameterNumber(self.CHUNK_SIZE,
+                                                       QCoreApplication.translate("AppendFeaturesToLayer", 'Chunk size (features written and committed at a time, 0 for all at once)'),
+                                                       QgsProcessingParameterNumber.Integer,
+                                                       0,
+                                                       True,
+                                                       0))
+        self.addParameter(QgsProcessingParameterNumber(self.WORKERS,
+                                                       QCoreApplication.translate("AppendFeaturesToLayer", 'Parallel workers (geometry conversion)'),
+                                                       QgsProcessingParameterNumber.Integer,
+                                                       1,
+                                                       True,
+                                                       1))
         self.addOutput(QgsProcessingOutputVectorLayer(self.OUTPUT,
                                                       QCoreApplication.translate("AppendFeaturesToLayer",
                                                                                  "Target layer to paste new features")))
@@ -130,13 +163,16 @@ class AppendFeaturesToLayer(QgsProcessingAlgorithm):
         target = self.parameterAsVectorLayer(parameters, self.OUTPUT, context)
         target_fields_parameter = self.parameterAsFields(parameters, self.OUTPUT_FIELD, context)
         action_on_duplicate = self.parameterAsEnum(parameters, self.ACTION_ON_DUPLICATE, context)
+        chunk_size = self.parameterAsInt(parameters, self.CHUNK_SIZE, context)
+        workers = max(1, self.parameterAsInt(parameters, self.WORKERS, context))
 
         results = {self.OUTPUT: None,
                    self.APPENDED_COUNT: None,
                    self.UPDATED_COUNT: None,
                    self.SKIPPED_COUNT: None}
 
-        target_value_dict = dict()
+        target_index = None
+        source_key = None
         source_field_unique_values = ''
         target_field_unique_values = ''
         source_field_type = None
@@ -186,118 +222,161 @@ class AppendFeaturesToLayer(QgsProcessingAlgorithm):
             if source_idx != -1:
                 mapping[target_idx] = source_idx
 
-        # Build dict of target field values so that we can search easily later {value1: [id1, id2], ...}
-        if target_field_unique_values:
-            for f in target.getFeatures():
-                if f[target_field_unique_values] in target_value_dict:
-                    target_value_dict[f[target_field_unique_values]].append(int(f.id()))
-                else:
-                    target_value_dict[f[target_field_unique_values]] = [int(f.id())]
+        # Build an index of target field values so that we can search easily later {value1: [id1, id2], ...}
+        if source_field_unique_values and target_field_unique_values:
+            # Source values are converted to keys of the index by a function resolved once for both field types
+            source_key = key_converter(source_field_type, target_field_type)
+            target_index = self.build_target_index(source, source_field_unique_values, source_key,
+                                                   target, target_field_unique_values, target_field_type,
+                                                   feedback)
+            feedback.pushInfo("Target index: {} features, {} distinct values, {:.1f} MB.".format(
+                len(target_index), target_index.key_count(), target_index.nbytes() / 1048576.0))
 
         # Prepare features for the Copy and Paste
         results[self.APPENDED_COUNT] = 0
         total = 100.0 / source.featureCount() if source.featureCount() else 0
         features = source.getFeatures()
-        destType = target.geometryType()
-        destIsMulti = QgsWkbTypes.isMultiType(target.wkbType())
         new_features = list()
         updated_features = dict()
         updated_geometries = dict()
-        updated_features_count = 0
-        updated_geometries_count = 0
+        appended_count = 0
+        append_attempted_count = 0
+        updated_feature_ids = set()  # A target feature updated by several chunks is counted once
+        updated_geometry_ids = set()
         skipped_features_count = 0  # To properly count features that were skipped
         duplicate_features_set = set()  # To properly count features that were updated
-        for current, in_feature in enumerate(features):
+        committed_chunks = 0
+
+        # A target that isn't open in the project has no undo stack to keep, so in streaming mode, where each chunk is
+        # committed anyway, updates go straight to its provider. Otherwise they stay in the single edit session,
+        # with the appends, so that the run is all or nothing
+        direct_updates = bool(chunk_size) and QgsProject.instance().mapLayer(target.id()) is None
+
+        def flush():
+            """
+            Write and commit the pending features, then forget them. Returns False if the edit session failed.
+            """
+            nonlocal appended_count, append_attempted_count, committed_chunks
+            if copy_writer is not None:
+                written = self.copy_features(target, copy_writer, new_features, feedback)
+            else:
+                if direct_updates:
+                    feature_ids, geometry_ids = self.write_updates_to_provider(target, updated_features,
+                                                                               updated_geometries, feedback)
+                    updated_feature_ids.update(feature_ids)
+                    updated_geometry_ids.update(geometry_ids)
+                    updated_features.clear()
+                    updated_geometries.clear()
+                written = self.write_changes(target, new_features, updated_features, updated_geometries, feedback)
+            if written is None:
+                return False
+
+            res_add_features, feature_ids, geometry_ids = written
+            append_attempted_count += len(new_features)
+            if res_add_features:
+                appended_count += len(new_features)
+            updated_feature_ids.update(feature_ids)
+            updated_geometry_ids.update(geometry_ids)
+            committed_chunks += 1
+
+            new_features.clear()
+            updated_features.clear()
+            updated_geometries.clear()
+            return True
+
+        # Avoid intersection if enabled in digitize settings, reading each layer only once
+        avoid = None
+        avoid_layers = QgsProject.instance().avoidIntersectionsLayers()
+        if avoid_layers and target.geometryType() == QgsWkbTypes.PolygonGeometry:
+            avoid = AvoidIntersectionsIndex(avoid_layers, source.sourceExtent(), feedback)
+            feedback.pushInfo("Avoiding intersections with {} layers.".format(len(avoid)))
+        stage = GeometryStage(target, avoid, workers)
+
+        # Plain appends to a PostGIS table are streamed with COPY, new features being kept as lines of COPY
+        copy_writer = None
+        if action_on_duplicate == self.NO_ACTION:
+            copy_writer = self.postgis_copy_writer(target, mapping, feedback)
+
+        def close_copy():
+            """
+            Close the COPY connection, and reload the target layer if features were appended behind its back.
+            """
+            if copy_writer is None:
+                return
+            copy_writer.close()
+            if appended_count:
+                target.reload()
+                target.updateExtents()
+                target.triggerRepaint()
+
+        def failed():
+            """
+            Close the COPY connection and return the results. In streaming mode, the chunks before the failed one
+            stay committed, so their counts are reported.
+            """
+            close_copy()
+            if chunk_size:
+                feedback.reportError("\nERROR: Chunk {} was rolled back, the {} chunks before it were committed to '{}'.".format(
+                    committed_chunks + 1,
+                    committed_chunks,
+                    target.name()
+                ))
+                results[self.APPENDED_COUNT] = appended_count
+                if action_on_duplicate == self.SKIP_FEATURE:
+                    results[self.SKIPPED_COUNT] = skipped_features_count
+                if action_on_duplicate == self.UPDATE_EXISTING_FEATURE:
+                    results[self.UPDATED_COUNT] = len(updated_feature_ids)
+            return results
+
+        features = self.prepared_features(features, source_field_unique_values, source_key, target_index, stage,
+                                          action_on_duplicate == self.SKIP_FEATURE)
+        for current, (in_feature, duplicate_target_ids, geom) in enumerate(features):
             if feedback.isCanceled():
                 break
 
             target_feature_exists = False
-            duplicate_target_value = None
 
             # If skip is the action, skip as soon as possible
             if source_field_unique_values:
-                duplicate_target, duplicate_target_value = self.find_duplicate_value(
-                    in_feature[source_field_unique_values],
-                    source_field_type,
-                    target_value_dict,
-                    target_field_type)
-                if duplicate_target:
+                if duplicate_target_ids:
                     if action_on_duplicate == self.SKIP_FEATURE:
-                        request = QgsFeatureRequest(target_value_dict[duplicate_target_value])  # Get target feature ids
-                        request.setFlags(QgsFeatureRequest.NoGeometry)
-                        request.setSubsetOfAttributes([])  # Note: this adds a new flag
-                        skipped_features_count += len([f for f in target.getFeatures(request)])
+                        # The index already holds the ids of the duplicates, no need to ask the target for them
+                        skipped_features_count += len(duplicate_target_ids)
                         continue
 
                     target_feature_exists = True
 
-            attrs = {target_idx: in_feature[source_idx] for target_idx, source_idx in mapping.items()}
-
-            geom = QgsGeometry()
-
-            if in_feature.hasGeometry() and target.isSpatial():
-                # Convert geometry to match destination layer
-                # Adapted from QGIS qgisapp.cpp, pasteFromClipboard()
-                geom = in_feature.geometry()
-
-                if not geom.isNull():
-                    if destType != QgsWkbTypes.UnknownGeometry:
-                        newGeometry = geom.convertToType(destType, destIsMulti)
-
-                        if newGeometry.isNull():
-                            continue  # Couldn't convert
-                        geom = newGeometry
+            # Geometry converted to match destination layer by the geometry stage
+            # Adapted from QGIS qgisapp.cpp, pasteFromClipboard()
+            if geom is None:
+                continue  # Couldn't convert
 
-                    # Avoid intersection if enabled in digitize settings
-                    geom.avoidIntersections(QgsProject.instance().avoidIntersectionsLayers())
+            attrs = {target_idx: in_feature[source_idx] for target_idx, source_idx in mapping.items()}
 
             if target_feature_exists and action_on_duplicate == self.UPDATE_EXISTING_FEATURE:
-                for t_f in target.getFeatures(target_value_dict[duplicate_target_value]):
-                    duplicate_features_set.add(t_f.id())
-                    updated_features[t_f.id()] = attrs
+                # The index already holds the ids of the duplicates, no need to ask the target for them
+                for t_f_id in duplicate_target_ids:
+                    duplicate_features_set.add(t_f_id)
+                    updated_features[t_f_id] = attrs
                     if target.isSpatial():
-                        updated_geometries[t_f.id()] = geom
+                        updated_geometries[t_f_id] = geom
+            elif copy_writer is not None:  # Append with COPY
+                new_features.append(copy_writer.line(attrs, geom))
             else:  # Append
                 new_feature = QgsVectorLayerUtils().createFeature(target, geom, attrs)
                 new_features.append(new_feature)
 
-            feedback.setProgress(int(current * total))
-
-        # Do the Copy and Paste
-        res_add_features = False
-        try:
-            with edit(target):
-                target.beginEditCommand("Appending/Updating features...")
-
-                if updated_features:
-                    for k, v in updated_features.items():
-                        if target.changeAttributeValues(k, v):
-                            updated_features_count += 1
-                        else:
-                            feedback.reportError("\nERROR: Target feature (id={}) couldn't be updated to the following attributes: {}.".format(k, v))
+            # Streaming mode: write and commit each chunk, so that only one chunk is kept in memory
+            if chunk_size and len(new_features) + len(updated_features) >= chunk_size:
+                if not flush():
+                    return failed()
 
-                if updated_geometries:
-                    for k,v in updated_geometries.items():
-                        if target.changeGeometry(k, v):
-                            updated_geometries_count += 1
-                        else:
-                            feedback.reportError("\nERROR: Target feature's geometry (id={}) couldn't be updated.".format(k))
-
-                if new_features:
-                    res_add_features = target.addFeatures(new_features)
-
-                target.endEditCommand()
-        except QgsEditError as e:
-            if not editable_before:
-                # Let's close the edit session to prepare for a next run
-                target.rollBack()
-
-            feedback.reportError("\nERROR: No features could be appended/updated to/in '{}', because of the following error:\n{}\n".format(
-                target.name(),
-                repr(e)
-            ))
-            return results
+            feedback.setProgress(int(current * total))
 
+        # Do the Copy and Paste (the last chunk, in streaming mode)
+        if not flush():
+            return failed()
+        close_copy()
 
         if action_on_duplicate == self.SKIP_FEATURE:
             feedback.pushInfo("\nSKIPPED FEATURES: {} duplicate features were skipped while copying features to '{}'!".format(
@@ -308,57 +387,271 @@ class AppendFeaturesToLayer(QgsProcessingAlgorithm):
 
         if action_on_duplicate == self.UPDATE_EXISTING_FEATURE:
             feedback.pushInfo("\nUPDATED FEATURES: {} out of {} duplicate features were updated while copying features to '{}'!".format(
-                updated_features_count,
+                len(updated_feature_ids),
                 len(duplicate_features_set),
                 target.name()
             ))
-            results[self.UPDATED_COUNT] = updated_features_count
+            results[self.UPDATED_COUNT] = len(updated_feature_ids)
 
-        if not new_features:
+        if not append_attempted_count:
             feedback.pushInfo("\nFINISHED WITHOUT APPENDED FEATURES: There were no features to append to '{}'.".format(
                 target.name()
             ))
         else:
-            if res_add_features:
+            if appended_count == append_attempted_count:
                 feedback.pushInfo("\nAPPENDED FEATURES: {} out of {} features from input layer were successfully appended to '{}'!".format(
-                    len(new_features),
+                    appended_count,
                     source.featureCount(),
                     target.name()
                 ))
-                results[self.APPENDED_COUNT] = len(new_features)
             else: # TODO do we really need this else message below?
-                feedback.reportError("\nERROR: The {} features from input layer could not be appended to '{}'. Sometimes this might be due to NOT NULL constraints that are not met.".format(
+                feedback.reportError("\nERROR: {} of the {} features from input layer could not be appended to '{}'. Sometimes this might be due to NOT NULL constraints that are not met.".format(
+                    append_attempted_count - appended_count,
                     source.featureCount(),
                     target.name()
                 ))
+            results[self.APPENDED_COUNT] = appended_count
 
         results[self.OUTPUT] = target
         return results
 
-    def find_duplicate_value(self, source_value, source_field_type, target_value_dict, target_field_type):
+    def build_target_index(self, source, source_field, source_key, target, target_field, target_field_type, feedback):
         """
-        Check if source_value is in target layer. First, as is, and if necessary as a converted value.
+        Read the target features whose value can be duplicated by the source, choosing the lookup by relative size.
+
+        A target much larger than the source is queried with the source values, in batched IN filters that the
+        provider runs itself, so that only the matching target features are fetched. Otherwise, the values of all
+        target features are read at once. Either way, only the target field is read, without geometries.
 
-        :param source_value: single value from the source layer
-        :param source_field_type: QVariant.Type
-        :param target_value_dict: dict of unique values in the target layer. We only use keys in this function.
-        :param target_field_type: QVariant.Type
-        :return: Whether the source_value is duplicated in the target layer and, if so, also the target value
+        Target values are stored as canonical keys (see key_index), so that a source value converted by source_key
+        is found directly. NULL values are not keys.
+
+        :return: KeyIndex {target key: target feature ids}
         """
-        # Direct comparison
-        if source_field_type == target_field_type:
-            if source_value in target_value_dict:
-                return True, source_value
-            else:
-                return False, None
-
-        # We first need to convert types before comparing...
-        qvariant_value = QVariant(source_value)
-        res_can_convert = qvariant_value.canConvert(target_field_type)
-        if res_can_convert:
-            res_convert = qvariant_value.convert(target_field_type)
-            if res_convert:
-                if qvariant_value.value() in target_value_dict:
-                    return True, qvariant_value.value()
-
-        return False, None
\ No newline at end of file
+        keys = key_array(target_field_type)
+        ids = array('q')
+        target_key = key_converter(target_field_type, target_field_type)
+        source_count = source.featureCount()
+        target_count = target.featureCount()
+
+        requests = list()
+        if 0 <= source_count and source_count * self.LOOKUP_RATIO < target_count:
+            values = list(self.source_lookup_values(source, source_field, source_key))
+            column = QgsExpression.quotedColumnRef(target_field)
+            for i in range(0, len(values), self.LOOKUP_BATCH_SIZE):
+                batch = values[i:i + self.LOOKUP_BATCH_SIZE]
+                requests.append(QgsFeatureRequest().setFilterExpression(
+                    "{} IN ({})".format(column, ', '.join(QgsExpression.quotedValue(value) for value in batch))))
+            feedback.pushInfo("\nLooking up {} source values in {} target features, in {} batches.".format(
+                len(values), target_count, len(requests)))
+        else:
+            requests.append(QgsFeatureRequest())
+            feedback.pushInfo("\nReading the values of {} target features.".format(target_count))
+
+        for request in requests:
+            if feedback.isCanceled():
+                break
+            request.setFlags(request.flags() | QgsFeatureRequest.NoGeometry)
+            request.setSubsetOfAttributes([target_field], target.fields())
+            for f in target.getFeatures(request):
+                key = target_key(f[target_field])
+                if key is None:
+                    continue
+                keys.append(key)
+                ids.append(f.id())
+
+        return KeyIndex(keys, ids)
+
+    def prepared_features(self, features, source_field, source_key, target_index, stage, skip_duplicates):
+        """
+        Yield each source feature with the ids of its duplicates in the target (None if it has none) and its geometry
+        in the target (None if it couldn't be converted), by chunks of LOOKUP_BATCH_SIZE source features: their keys
+        are looked up in the target index at once, and their geometries converted at once by the geometry stage.
+        The geometry stage is closed when the features are exhausted or no longer read.
+
+        :param skip_duplicates: Whether duplicates are skipped, so they need no geometry
+        """
+        try:
+            chunk = list()
+            for feature in features:
+                chunk.append(feature)
+                if len(chunk) == self.LOOKUP_BATCH_SIZE:
+                    yield from self.prepare_chunk(chunk, source_field, source_key, target_index, stage, skip_duplicates)
+                    chunk = list()
+            yield from self.prepare_chunk(chunk, source_field, source_key, target_index, stage, skip_duplicates)
+        finally:
+            stage.close()
+
+    def prepare_chunk(self, chunk, source_field, source_key, target_index, stage, skip_duplicates):
+        duplicates = [None] * len(chunk)
+        if target_index is not None:
+            keys = [source_key(feature[source_field]) for feature in chunk]
+            found = target_index.lookup(keys)
+            duplicates = [found.get(key) for key in keys]
+
+        geometries = [None] * len(chunk)
+        pending = [i for i in range(len(chunk)) if not (skip_duplicates and duplicates[i])]
+        for i, geometry in zip(pending, stage.geometries([chunk[i] for i in pending])):
+            geometries[i] = geometry
+        return zip(chunk, duplicates, geometries)
+
+    def source_lookup_values(self, source, source_field, source_key):
+        """
+        Distinct keys of the values of the source field, without NULLs and values that can't be converted.
+        """
+        request = QgsFeatureRequest().setFlags(QgsFeatureRequest.NoGeometry)
+        request.setSubsetOfAttributes([source_field], source.fields())
+        values = {source_key(f[source_field]) for f in source.getFeatures(request)}
+        values.discard(None)
+        return values
+
+    def postgis_copy_writer(self, target, mapping, feedback):
+        """
+        CopyWriter appending to the table of a PostGIS target layer, or None if the target isn't a PostGIS table (a
+        view or a foreign table can't take a COPY) or can't be connected to, in which case features are appended
+        through the layer.
+
+        Only the mapped fields that come from the table are copied. The source values of the primary key are kept,
+        a primary key with a default value (a serial) being left to the database only for NULL source values.
+        """
+        provider = target.dataProvider()
+        if provider.name() != 'postgres':
+            return None
+
+        uri = QgsDataSourceUri(target.source())
+        if not uri.table() or uri.table().startswith('('):
+            return None  # Query layer
+
+        fields = target.fields()
+        key_indexes = provider.pkAttributeIndexes()
+        columns = [(index, fields.field(index).name()) for index in sorted(mapping)
+                   if fields.fieldOrigin(index) == QgsFields.OriginProvider]
+        default_columns = [index for index in key_indexes if provider.defaultValueClause(index)]
+        geometry_column = uri.geometryColumn() if target.isSpatial() else None
+        srid = int(uri.srid()) if uri.srid() else target.crs().postgisSrid()
+
+        table = quote_table(uri.schema(), uri.table()) if uri.schema() else quote_ident(uri.table())
+        try:
+            con = pg_connect_info(uri)
+        except Exception as e:
+            feedback.pushInfo("\nWARNING: Couldn't connect to the table of '{}' to append with COPY, appending through the layer: {}".format(
+                target.name(), e))
+            return None
+
+        try:
+            with con:
+                cur = con.cursor()
+                cur.execute("SELECT relkind FROM pg_catalog.pg_class WHERE oid = to_regclass(%s)", (table,))
+                row = cur.fetchone()
+                cur.close()
+        except Exception:
+            row = None
+        if row is None or row[0] not in BASE_TABLE_KINDS:
+            con.close()
+            return None
+
+        feedback.pushInfo("\nAppending to the PostGIS table of '{}' with COPY.".format(target.name()))
+        return CopyWriter(con, uri.schema(), uri.table(), columns, geometry_column, srid, default_columns)
+
+    def copy_features(self, target, copy_writer, lines, feedback):
+        """
+        Append lines of COPY to the table of the target layer, in a single transaction.
+
+        :return: Tuple (whether new features were appended, no updated ids, no updated ids), as write_changes, or None
+                 if the copy failed and was rolled back
+        """
+        if not lines:
+            return False, set(), set()
+
+        try:
+            copy_writer.write(lines)
+        except Exception as e:
+            feedback.reportError("\nERROR: The {} features of this copy couldn't be appended to '{}' and were rolled back, because of the following error:\n{}\n".format(
+                len(lines),
+                target.name(),
+                repr(e)
+            ))
+            return None
+
+        return True, set(), set()
+
+    def write_changes(self, target, new_features, updated_features, updated_geometries, feedback):
+        """
+        Write features to the target layer in a single edit session, committed at the end.
+
+        :param target: QgsVectorLayer to write to, not in edit mode
+        :param new_features: list of QgsFeature to append
+        :param updated_features: dict {target feature id: {field index: value}}
+        :param updated_geometries: dict {target feature id: QgsGeometry}
+        :param feedback: QgsProcessingFeedback
+        :return: Tuple (whether new features were appended, ids of the features updated, ids of the geometries
+                 updated), or None if the edit session failed and was rolled back
+        """
+        res_add_features = False
+        updated_feature_ids = set()
+        updated_geometry_ids = set()
+
+        if not (new_features or updated_features or updated_geometries):
+            return res_add_features, updated_feature_ids, updated_geometry_ids
+
+        try:
+            with edit(target):
+                target.beginEditCommand("Appending/Updating features...")
+
+                if updated_features:
+                    for k, v in updated_features.items():
+                        if target.changeAttributeValues(k, v):
+                            updated_feature_ids.add(k)
+                        else:
+                            feedback.reportError("\nERROR: Target feature (id={}) couldn't be updated to the following attributes: {}.".format(k, v))
+
+                if updated_geometries:
+                    for k,v in updated_geometries.items():
+                        if target.changeGeometry(k, v):
+                            updated_geometry_ids.add(k)
+                        else:
+                            feedback.reportError("\nERROR: Target feature's geometry (id={}) couldn't be updated.".format(k))
+
+                if new_features:
+                    res_add_features = target.addFeatures(new_features)
+
+                target.endEditCommand()
+        except QgsEditError as e:
+            # Let's close the edit session to prepare for a next run
+            target.rollBack()
+
+            feedback.reportError("\nERROR: The features of this edit session couldn't be appended/updated to/in '{}' and were rolled back, because of the following error:\n{}\n".format(
+                target.name(),
+                repr(e)
+            ))
+            return None
+
+        return res_add_features, updated_feature_ids, updated_geometry_ids
+
+    def write_updates_to_provider(self, target, updated_features, updated_geometries, feedback):
+        """
+        Write updates straight to the data provider of the target layer, bypassing its edit buffer and undo stack.
+
+        Updates are grouped in maps of UPDATE_BATCH_SIZE features, each one written (and committed by the provider)
+        with a single call.
+
+        :return: Tuple (ids of the features updated, ids of the geometries updated)
+        """
+        provider = target.dataProvider()
+        updated = list()
+        for changes, change_values, what in [(updated_features, provider.changeAttributeValues, 'attributes'),
+                                             (updated_geometries, provider.changeGeometryValues, 'geometries')]:
+            updated_ids = set()
+            ids = list(changes)
+            for i in range(0, len(ids), self.UPDATE_BATCH_SIZE):
+                batch = {fid: changes[fid] for fid in ids[i:i + self.UPDATE_BATCH_SIZE]}
+                if change_values(batch):
+                    updated_ids.update(batch)
+                else:
+                    feedback.reportError("\nERROR: The {} of {} target features couldn't be updated: {}".format(
+                        what, len(batch), '; '.join(provider.errors())))
+            updated.append(updated_ids)
+
+        if updated_features or updated_geometries:
+            target.triggerRepaint()
+        return updated[0], updated[1]
@@ -0,0 +1,885 @@
+# -*- coding: utf-8 -*-
+
+"""
+***************************************************************************
+*                                                                         *
+*   This program is free software; you can redistribute it and/or modify  *
+*   it under the terms of the GNU General Public License as published by  *
+*   the Free Software Foundation; either version 2 of the License, or     *
+*   (at your option) any later version.                                   *
+*                                                                         *
+***************************************************************************
+"""
+
+import hashlib
+import json
+import sqlite3 as lite
+import struct
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import psycopg2
+from osgeo import ogr
+from qgis.PyQt.QtCore import QByteArray, QDate, QDateTime, QTime, Qt
+from qgis.core import NULL
+
+from .concurrency import run_concurrently
+from .export_engine import CHANGELOG_SOURCE_TABLE, CHANGELOG_TABLE, sql_literal
+from .schema_introspection import INTERNAL_TABLES, pg_connection_pool, quote_ident, quote_table
+
+
+# EWKB flag telling that the SRID follows the geometry type
+EWKB_SRID_FLAG = 0x20000000
+
+# Actions on duplicate keys of the bulk load, as in the append algorithm
+NO_ACTION = 0
+SKIP_FEATURE = 1
+UPDATE_EXISTING_FEATURE = 2
+
+# Rows of a layer inserted, updated, skipped (duplicated or unchanged) and deleted by the bulk load
+LoadCounts = namedtuple('LoadCounts', ['inserted', 'updated', 'skipped', 'deleted'])
+
+# Table of the target schema recording the layers imported from each geopackage
+JOURNAL_TABLE = INTERNAL_TABLES[0]
+
+# Table of the target schema recording the indexes and triggers suspended by the bulk load
+SUSPENDED_TABLE = INTERNAL_TABLES[1]
+
+# Table of the target schema with the key of the row loaded from each feature inserted in a copy of a geopackage
+IMPORTED_TABLE = INTERNAL_TABLES[2]
+
+# Edits of a layer in the change log of a geopackage: features inserted and updated, fids of the features of the
+# export deleted and of the features inserted then deleted, and the source id of the layer copy
+LayerChanges = namedtuple('LayerChanges', ['inserted', 'updated', 'deleted', 'discarded', 'source'])
+
+# Non-unique indexes not backing a constraint (unique, exclusion and constraint indexes are kept for the
+# integrity and the merge) and enabled user triggers of tables
+SUSPENDABLE_QUERY = """
+SELECT t.relname, 'index', i.relname, pg_get_indexdef(i.oid)
+FROM pg_catalog.pg_index x
+JOIN pg_catalog.pg_class i ON i.oid = x.indexrelid
+JOIN pg_catalog.pg_class t ON t.oid = x.indrelid
+JOIN pg_catalog.pg_namespace n ON n.oid = t.relnamespace
+WHERE n.nspname = %s AND t.relname = ANY(%s)
+  AND NOT x.indisunique AND NOT x.indisexclusion
+  AND NOT EXISTS (SELECT 1 FROM pg_catalog.pg_constraint c WHERE c.conindid = x.indexrelid)
+UNION ALL
+SELECT t.relname, 'trigger', g.tgname, NULL
+FROM pg_catalog.pg_trigger g
+JOIN pg_catalog.pg_class t ON t.oid = g.tgrelid
+JOIN pg_catalog.pg_namespace n ON n.oid = t.relnamespace
+WHERE n.nspname = %s AND t.relname = ANY(%s) AND NOT g.tgisinternal AND g.tgenabled <> 'D'
+"""
+
+# Temporary table receiving the COPY of a layer before the merge, dropped at commit
+STAGING_TABLE = 'publibase_staging'
+
+# Temporary table receiving the COPY of the features inserted in a geopackage, dropped at commit
+INSERTED_STAGING_TABLE = 'publibase_staging_inserted'
+
+# Description of a geometry layer of a geopackage, feature_count is None when unknown
+LayerInfo = namedtuple('LayerInfo', ['name', 'geometry_column', 'geometry_type', 'srs_id', 'extent', 'feature_count'])
+
+# Layers, geometry columns, extents and, when OGR keeps them, feature counts in one query
+GEOPACKAGE_LAYERS_QUERY = """
+SELECT g.table_name, g.column_name, g.geometry_type_name, g.srs_id,
+       c.min_x, c.min_y, c.max_x, c.max_y, {}
+FROM gpkg_geometry_columns g
+JOIN gpkg_contents c ON c.table_name = g.table_name
+{}
+"""
+
+
+
+class CopyCanceled(Exception):
+    '''Raised inside COPY when the feedback is canceled, so the transaction is rolled back.
+
+       psycopg2 turns an exception raised while reading the stream into an
+       error of its own, so a cancel is caught as a psycopg2.Error with the
+       feedback canceled.'''
+
+
+
+class CopyStream:
+    '''File-like object feeding COPY FROM STDIN with the lines of an iterator.'''
+
+    def __init__(self, lines):
+        self._lines = iter(lines)
+
+    def read(self, size=-1):
+        chunk = []
+        length = 0
+        for line in self._lines:
+            chunk.append(line)
+            length += len(line)
+            if 0 <= size <= length:
+                break
+        return ''.join(chunk)
+
+    readline = read
+
+
+
+def copy_text(value):
+    '''Escape a value for the text format of COPY.'''
+    return value.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+def ewkb_hex(geometry, srid):
+    '''Hexadecimal EWKB of an OGR geometry, with the SRID of the target column.'''
+    # The old OGC variant uses the same Z flag as EWKB
+    wkb = bytes(geometry.ExportToWkb(ogr.wkbNDR))
+    geom_type = struct.unpack('<I', wkb[1:5])[0]
+    if srid:
+        wkb = wkb[:1] + struct.pack('<II', geom_type | EWKB_SRID_FLAG, srid) + wkb[5:]
+    return wkb.hex()
+
+
+def qgs_ewkb_hex(geometry, srid):
+    '''Hexadecimal EWKB of a QgsGeometry, with the SRID of the target column.'''
+    # PostGIS reads the ISO WKB types of QGIS along with the EWKB flags
+    wkb = bytes(geometry.asWkb())
+    byte_order = '<' if wkb[0] == 1 else '>'
+    geom_type = struct.unpack(byte_order + 'I', wkb[1:5])[0]
+    if srid:
+        wkb = wkb[:1] + struct.pack(byte_order + 'II', geom_type | EWKB_SRID_FLAG, srid) + wkb[5:]
+    return wkb.hex()
+
+
+def _array_literal(values):
+    return '{' + ','.join('NULL' if value is None or value == NULL else
+                          '"' + qgs_text(value).replace('\\', '\\\\').replace('"', '\\"') + '"'
+                          for value in values) + '}'
+
+
+def qgs_text(value):
+    '''PostgreSQL input text of a QGIS attribute value.'''
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    if isinstance(value, QDateTime):
+        return value.toString(Qt.ISODateWithMs)
+    if isinstance(value, QDate):
+        return value.toString(Qt.ISODate)
+    if isinstance(value, QTime):
+        return value.toString('HH:mm:ss.zzz')
+    if isinstance(value, (QByteArray, bytes)):
+        return '\\x' + bytes(value).hex()
+    if isinstance(value, (list, tuple)):
+        return _array_literal(value)
+    if isinstance(value, dict):
+        return json.dumps(value)
+    return str(value)
+
+
+def qgs_copy_value(value):
+    '''Field of a line of COPY (text format) with a QGIS attribute value.'''
+    if value is None or value == NULL:
+        return '\\N'
+    return copy_text(qgs_text(value))
+
+
+def geopackage_layers(geopackage, non_empty=True):
+    '''Description (LayerInfo) of the geometry layers of a geopackage, read in one pass.
+
+       The feature counts come from gpkg_ogr_contents, kept up to date by OGR.
+       When the table doesn't exist or a count isn't known, the layer is probed
+       with EXISTS instead of being counted. With non_empty, only the layers
+       with features are returned.'''
+    con = lite.connect(geopackage)
+    try:
+        cur = con.cursor()
+        cur.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'gpkg_ogr_contents'")
+        if cur.fetchone():
+            query = GEOPACKAGE_LAYERS_QUERY.format('o.feature_count',
+                                                   'LEFT JOIN gpkg_ogr_contents o ON lower(o.table_name) = lower(g.table_name)')
+        else:
+            query = GEOPACKAGE_LAYERS_QUERY.format('NULL', '')
+        cur.execute(query)
+
+        layers = []
+        for name, geometry_column, geometry_type, srs_id, min_x, min_y, max_x, max_y, feature_count in cur.fetchall():
+            if feature_count is None:
+                cur.execute('SELECT EXISTS (SELECT 1 FROM {} LIMIT 1)'.format(quote_ident(name)))
+                if not cur.fetchone()[0]:
+                    feature_count = 0
+            extent = (min_x, min_y, max_x, max_y) if min_x is not None else None
+            layers.append(LayerInfo(name, geometry_column, geometry_type, srs_id, extent, feature_count))
+        cur.close()
+    finally:
+        con.close()
+
+    if non_empty:
+        layers = [layer for layer in layers if layer.feature_count != 0]
+    return layers
+
+
+def read_changelog(geopackage):
+    '''{layer: LayerChanges} of the change log of the geopackage, None if the
+       geopackage has no change log.'''
+    con = lite.connect(geopackage)
+    try:
+        cur = con.cursor()
+        cur.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = ?", (CHANGELOG_TABLE,))
+        if cur.fetchone() is None:
+            return None
+        cur.execute("SELECT table_name, operation, fid FROM {}".format(CHANGELOG_TABLE))
+        changes = dict()
+        for layer, operation, fid in cur.fetchall():
+            change = changes.setdefault(layer, [0, 0, [], []])
+            if operation == 'D':
+                change[2].append(fid)
+            elif operation == 'X':
+                change[3].append(fid)
+            else:
+                change[0 if operation == 'I' else 1] += 1
+        cur.execute("SELECT table_name, source FROM {}".format(CHANGELOG_SOURCE_TABLE))
+        sources = dict(cur.fetchall())
+        cur.close()
+    finally:
+        con.close()
+    return {layer: LayerChanges(*change, source=sources.get(layer)) for layer, change in changes.items()}
+
+
+def _date_time_text(feature, index, field_type):
+    year, month, day, hour, minute, second, tz = feature.GetFieldAsDateTime(index)
+    if field_type == ogr.OFTDate:
+        return '{:04d}-{:02d}-{:02d}'.format(year, month, day)
+    text = '{:02d}:{:02d}:{:06.3f}'.format(hour, minute, second)
+    if field_type == ogr.OFTDateTime:
+        text = '{:04d}-{:02d}-{:02d} {}'.format(year, month, day, text)
+        # 100 is UTC, each unit above or below is 15 minutes of offset
+        if tz >= 100:
+            offset = (tz - 100) * 15
+            text += '{}{:02d}:{:02d}'.format('+' if offset >= 0 else '-', abs(offset) // 60, abs(offset) % 60)
+    return text
+
+
+def field_converter(field_defn):
+    '''Function (feature, index) -> COPY text of a field, resolved once per field.'''
+    field_type = field_defn.GetType()
+    if field_type in (ogr.OFTDate, ogr.OFTTime, ogr.OFTDateTime):
+        return lambda feature, index: _date_time_text(feature, index, field_type)
+    if field_type == ogr.OFTBinary:
+        return lambda feature, index: copy_text('\\x' + feature.GetFieldAsBinary(index).hex())
+    if field_type in (ogr.OFTInteger, ogr.OFTInteger64):
+        return lambda feature, index: str(feature.GetFieldAsInteger64(index))
+    if field_type == ogr.OFTReal:
+        return lambda feature, index: repr(feature.GetFieldAsDouble(index))
+    return lambda feature, index: copy_text(feature.GetFieldAsString(index))
+
+
+def copy_columns(source_layer, table_info):
+    '''Map the source layer to the target table.
+
+       Return (target columns, [(source field index, converter)], copy FID, copy geometry).
+       As in the append algorithm, only the fields found in both layers are copied,
+       the FID column included when the target has a column with its name.'''
+    layer_defn = source_layer.GetLayerDefn()
+    columns = []
+    fields = []
+
+    fid_column = source_layer.GetFIDColumn()
+    copy_fid = bool(fid_column) and fid_column in table_info.columns
+    if copy_fid:
+        columns.append(fid_column)
+
+    for index in range(layer_defn.GetFieldCount()):
+        field_defn = layer_defn.GetFieldDefn(index)
+        name = field_defn.GetName()
+        if name in table_info.columns and name != table_info.geometry_column and name != fid_column and name not in columns:
+            columns.append(name)
+            fields.append((index, field_converter(field_defn)))
+
+    copy_geometry = table_info.geometry_column is not None and layer_defn.GetGeomFieldCount() > 0
+    if copy_geometry:
+        columns.append(table_info.geometry_column)
+
+    return columns, fields, copy_fid, copy_geometry
+
+
+def copy_lines(source_layer, table_info, fields, copy_fid, copy_geometry, feedback, progress, total=None):
+    '''Lines of COPY text format for each feature of the source layer.'''
+    geom_type = source_layer.GetGeomType()
+    if total is None:
+        total = source_layer.GetFeatureCount()
+    step = max(total // 100, 1)
+
+    source_layer.ResetReading()
+    for current, feature in enumerate(source_layer):
+        if current % step == 0:
+            if feedback.isCanceled():
+                raise CopyCanceled()
+            if progress is not None and total:
+                feedback.setProgress(progress[0] + int((progress[1] - progress[0]) * current / total))
+
+        values = [str(feature.GetFID())] if copy_fid else []
+        for index, converter in fields:
+            values.append(converter(feature, index) if feature.IsFieldSetAndNotNull(index) else '\\N')
+
+        if copy_geometry:
+            geometry = feature.GetGeometryRef()
+            if geometry is None or geometry.IsEmpty():
+                values.append('\\N')
+            else:
+                # Geometries edited in the field may be single parts in a multi layer
+                if geometry.GetGeometryType() != geom_type and geom_type != ogr.wkbUnknown:
+                    geometry = ogr.ForceTo(geometry.Clone(), geom_type)
+                values.append(ewkb_hex(geometry, table_info.srid))
+
+        yield '\t'.join(values) + '\n'
+
+
+def copy_transaction(con, feedback, work):
+    '''Call work(cursor) in one transaction of con and return its result, or
+       None if the feedback was canceled, in which case the transaction is
+       rolled back.'''
+    try:
+        with con:
+            cur = con.cursor()
+            result = work(cur)
+            cur.close()
+    except CopyCanceled:
+        return None
+    except psycopg2.Error:
+        # psycopg2 re-raises the CopyCanceled of the stream as an error of its own
+        if feedback.isCanceled():
+            return None
+        raise
+    return result
+
+
+def copy_layer(con, source_layer, schema, table_info, feedback, progress=(0, 100), total=None, before_commit=None):
+    '''Append the features of an OGR layer to a PostGIS table with COPY, in one transaction.
+
+       The fields are mapped by name and the geometries are sent as EWKB. total
+       is the feature count of the layer, if already known. before_commit(cursor,
+       LoadCounts) runs in the same transaction, after the copy. Return the number
+       of rows copied, or None if the feedback was canceled, in which case the
+       transaction is rolled back.'''
+    def work(cur):
+        rowcount = copy_rows(cur, source_layer, schema, table_info, feedback, progress, total)
+        if before_commit is not None:
+            before_commit(cur, LoadCounts(rowcount, 0, 0, 0))
+        return rowcount
+
+    return copy_transaction(con, feedback, work)
+
+
+def copy_rows(cur, source_layer, schema, table_info, feedback, progress=(0, 100), total=None):
+    '''COPY the features of an OGR layer into a PostGIS table with a cursor,
+       in the transaction of the cursor (see copy_layer). Return the number of
+       rows copied.'''
+    columns, fields, copy_fid, copy_geometry = copy_columns(source_layer, table_info)
+    copy_sql = 'COPY {} ({}) FROM STDIN'.format(quote_table(schema, table_info.name),
+                                                   ', '.join(quote_ident(column) for column in columns))
+
+    lines = copy_lines(source_layer, table_info, fields, copy_fid, copy_geometry, feedback, progress, total)
+    cur.copy_expert(copy_sql, CopyStream(lines))
+    return cur.rowcount
+
+
+def merge_sql(target, staging, columns, key, update):
+    '''INSERT ... ON CONFLICT merging staging into target on the key columns,
+       returning the inserted and the updated counts.
+
+       With update, the duplicates are updated, unless they are unchanged, else
+       they are skipped. Duplicates inside staging are merged only once.'''
+    column_list = ', '.join(quote_ident(column) for column in columns)
+    key_list = ', '.join(quote_ident(column) for column in key)
+    values = [quote_ident(column) for column in columns if column not in key]
+    if update and values:
+        conflict = 'DO UPDATE SET {} WHERE ({}) IS DISTINCT FROM ({})'.format(
+            ', '.join('{0} = EXCLUDED.{0}'.format(value) for value in values),
+            ', '.join('t.' + value for value in values),
+            ', '.join('EXCLUDED.' + value for value in values))
+    else:
+        conflict = 'DO NOTHING'
+    # xmax is 0 in the rows inserted and the id of the transaction in the rows updated
+    return ('WITH merged AS (INSERT INTO {0} AS t ({1}) SELECT DISTINCT ON ({2}) {1} FROM {3} ORDER BY {2} '
+            'ON CONFLICT ({2}) {4} RETURNING (xmax = 0) AS inserted) '
+            'SELECT count(*) FILTER (WHERE inserted), count(*) FILTER (WHERE NOT inserted) FROM merged'
+            ).format(target, column_list, key_list, staging, conflict)
+
+
+def merge_layer(con, source_layer, schema, table_info, key, update, feedback, progress=(0, 100), total=None,
+                before_commit=None, deleted=()):
+    '''Merge the features of an OGR layer into a PostGIS table on the key columns, in one transaction.
+
+       The layer is copied into a temporary (unlogged) staging table, then
+       merged by the server with INSERT ... ON CONFLICT, so the key must be the
+       primary key or have a unique index. With update, the duplicates are
+       updated, else skipped. The rows whose key (a single column) is in
+       deleted are deleted in the same transaction. before_commit is called as
+       in copy_layer. Return the LoadCounts, or None if the feedback was
+       canceled, in which case the transaction is rolled back.'''
+    def work(cur):
+        counts = merge_rows(cur, source_layer, schema, table_info, key, update, feedback, progress, total, deleted)
+        if before_commit is not None:
+            before_commit(cur, counts)
+        return counts
+
+    return copy_transaction(con, feedback, work)
+
+
+def merge_rows(cur, source_layer, schema, table_info, key, update, feedback, progress=(0, 100), total=None, deleted=()):
+    '''Merge the features of an OGR layer into a PostGIS table with a cursor,
+       in the transaction of the cursor (see merge_layer). Return the LoadCounts.'''
+    columns, fields, copy_fid, copy_geometry = copy_columns(source_layer, table_info)
+    missing = [column for column in key if column not in columns]
+    if missing:
+        raise ValueError('Key column {} not found in layer {}'.format(', '.join(missing), table_info.name))
+
+    target = quote_table(schema, table_info.name)
+    staging = quote_ident(STAGING_TABLE)
+    column_list = ', '.join(quote_ident(column) for column in columns)
+
+    lines = copy_lines(source_layer, table_info, fields, copy_fid, copy_geometry, feedback, progress, total)
+    # Only the copied columns, without constraints or defaults
+    cur.execute('CREATE TEMP TABLE {} ON COMMIT DROP AS SELECT {} FROM {} WITH NO DATA'.format(
+        staging, column_list, target))
+    cur.copy_expert('COPY {} ({}) FROM STDIN'.format(staging, column_list), CopyStream(lines))
+    staged = cur.rowcount
+    cur.execute(merge_sql(target, staging, columns, key, update))
+    inserted, updated = cur.fetchone()
+    removed = 0
+    if deleted:
+        cur.execute('DELETE FROM {} WHERE {} = ANY(%s)'.format(quote_table(schema, table_info.name, True),
+                                                             quote_ident(key[0]).replace('%', '%%')), (list(deleted),))
+        removed = cur.rowcount
+    return LoadCounts(inserted, updated, staged - inserted - updated, removed)
+
+
+def file_hash(path):
+    '''md5 of the content of a file, read in blocks.'''
+    digest = hashlib.md5()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def format_counts(counts):
+    '''Text of the LoadCounts of a layer.'''
+    return '{} inserted, {} updated, {} skipped, {} deleted'.format(counts.inserted, counts.updated, counts.skipped,
+                                                                    counts.deleted)
+
+
+def column_default(cur, table, column):
+    '''SQL expression of the default of a column of a table (quoted, with its
+       schema), the sequence of an identity column included, None if it has none.'''
+    cur.execute("SELECT COALESCE(pg_get_expr(d.adbin, d.adrelid), "
+                "'nextval(' || quote_literal(pg_get_serial_sequence(%s, %s)) || '::regclass)') "
+                "FROM pg_catalog.pg_attribute a "
+                "LEFT JOIN pg_catalog.pg_attrdef d ON d.adrelid = a.attrelid AND d.adnum = a.attnum "
+                "WHERE a.attrelid = %s::regclass AND a.attname = %s", (table, column, table, column))
+    row = cur.fetchone()
+    return row[0] if row else None
+
+
+def replay_rows(cur, source_layer, schema, table_info, source, feedback, progress=(0, 100), total=None,
+                discarded=()):
+    '''Load the features of an OGR layer inserted in a copy of a geopackage
+       (source being the id of the layer copy, see install_changelog) into a
+       PostGIS table with a cursor, in the transaction of the cursor.
+
+       The FID column of the layer is the key of the table, but the fid of an
+       inserted feature was only assigned by the geopackage, so the feature
+       gets a key from the default of the column, recorded in the imported
+       table of the schema. A feature already loaded by a previous import of
+       the copy updates the row it was loaded into, so importing the copy again
+       doesn't insert it twice. The rows loaded from the features of discarded
+       (fids of features inserted then deleted in the copy) are deleted.
+       Return the LoadCounts.'''
+    fid_column = source_layer.GetFIDColumn()
+    columns, fields, copy_fid, copy_geometry = copy_columns(source_layer, table_info)
+    key_type = table_info.column_types[table_info.columns.index(fid_column)]
+    default = column_default(cur, quote_table(schema, table_info.name), fid_column)
+    if default is None:
+        raise ValueError('The FID column of table {} has no default value'.format(table_info.name))
+
+    # The names, and the default, are in queries with parameters
+    def ident(name):
+        return quote_ident(name).replace('%', '%%')
+    target = quote_table(schema, table_info.name, True)
+    imported = quote_table(schema, IMPORTED_TABLE, True)
+    staging = quote_ident(INSERTED_STAGING_TABLE)
+    fid = ident(fid_column)
+    values = [ident(column) for column in columns if column != fid_column]
+    column_list = ', '.join(quote_ident(column) for column in columns)
+
+    lines = copy_lines(source_layer, table_info, fields, copy_fid, copy_geometry, feedback, progress, total)
+    cur.execute('CREATE TEMP TABLE {} ON COMMIT DROP AS SELECT {} FROM {} WITH NO DATA'.format(
+        staging, column_list, quote_table(schema, table_info.name)))
+    cur.copy_expert('COPY {} ({}) FROM STDIN'.format(staging, column_list), CopyStream(lines))
+    staged = cur.rowcount
+
+    updated = 0
+    if values:
+        cur.execute('UPDATE {0} t SET {1} FROM {2} s JOIN {3} j ON j.fid = s.{4} '
+                    'WHERE j.source = %s AND j.table_name = %s AND t.{4} = CAST(j.key AS {5}) '
+                    'AND ({6}) IS DISTINCT FROM ({7})'.format(
+                        target, ', '.join('{0} = s.{0}'.format(value) for value in values), staging, imported, fid,
+                        key_type, ', '.join('t.' + value for value in values), ', '.join('s.' + value for value in values)),
+                    (source, table_info.name))
+        updated = cur.rowcount
+
+    # The key of each new row is drawn once, in the CTE read by both inserts, and the primary key of the
+    # imported table refuses a feature loaded twice
+    cur.execute('WITH new AS (SELECT s.*, {0} AS publibase_key FROM {1} s WHERE NOT EXISTS '
+                '(SELECT 1 FROM {2} j WHERE j.source = %s AND j.table_name = %s AND j.fid = s.{3})), '
+                'loaded AS (INSERT INTO {4} ({5}) SELECT {6} FROM new) '
+                'INSERT INTO {2} (source, table_name, fid, key) SELECT %s, %s, {3}, publibase_key::text FROM new'.format(
+                    default.replace('%', '%%'), staging, imported, fid, target, ', '.join([fid] + values),
+                    ', '.join(['publibase_key'] + values)),
+                (source, table_info.name, source, table_info.name))
+    inserted = cur.rowcount
+
+    deleted = 0
+    if discarded:
+        cur.execute('WITH dropped AS (DELETE FROM {} j WHERE j.source = %s AND j.table_name = %s AND j.fid = ANY(%s) '
+                    'RETURNING key) DELETE FROM {} t USING dropped d WHERE t.{} = CAST(d.key AS {})'.format(
+                        imported, target, fid, key_type), (source, table_info.name, list(discarded)))
+        deleted = cur.rowcount
+    return LoadCounts(inserted, updated, staged - inserted - updated, deleted)
+
+
+class LayerLoader:
+    '''Bulk load layers of a geopackage into the tables of a PostGIS schema with COPY.
+
+       Connections come from a pool of at most size connections and the
+       geopackage is opened once per thread, since an OGR dataset can't be
+       shared between threads, so a serial import uses a single connection
+       and a pool of workers one connection per worker.
+
+       action tells what to do with the features whose key (a list of
+       columns, the primary key of each table if empty) is already in the
+       table: NO_ACTION appends them, SKIP_FEATURE and UPDATE_EXISTING_FEATURE
+       merge them on the server (see merge_layer).
+
+       With a journal (the hash of the geopackage), every layer loaded is
+       recorded in the journal table of the schema in the transaction of its
+       load, so a layer is either loaded and recorded or neither, and a rerun
+       of the same geopackage can skip the layers already loaded.
+
+       With changes (see read_changelog), only the features of the change log
+       of the geopackage are loaded, whatever the action: the features updated
+       are merged on the FID column, the features inserted are loaded with a
+       key from the default of the column (see replay_rows), since their fid
+       was only assigned by the geopackage, and the features deleted in the
+       geopackage are deleted.'''
+
+    def __init__(self, uri, schema, catalog, geopackage, feedback, size=1, action=NO_ACTION, key=None, journal=None,
+                 changes=None):
+        self.schema = schema
+        self.changes = changes
+        self.journal = journal
+        self.action = action
+        self.key = key
+        self.catalog = catalog
+        self.geopackage = geopackage
+        self.feedback = feedback
+        self._pool = pg_connection_pool(uri, size)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._datasets = []
+        if changes is not None:
+            self._create_imported_table()
+
+    def dataset(self):
+        '''Geopackage dataset of the current thread.'''
+        dataset = getattr(self._local, 'dataset', None)
+        if dataset is None:
+            dataset = ogr.Open(self.geopackage)
+            self._local.dataset = dataset
+            with self._lock:
+                self._datasets.append(dataset)
+        return dataset
+
+    def load(self, layer, progress=(0, 100), total=None):
+        '''Load a layer into the table with the same name. total is the feature
+           count of the layer, if known. Return the LoadCounts, None if canceled.'''
+        table_info = self.catalog.table(layer)
+        if table_info is None:
+            raise ValueError('Target table {}.{} not found'.format(self.schema, layer))
+        source_layer = self.dataset().GetLayerByName(layer)
+        if source_layer is None:
+            raise ValueError('Layer {} not found in the geopackage'.format(layer))
+
+        key = self.key or table_info.primary_key
+        if self.action != NO_ACTION and not key:
+            raise ValueError('Table {}.{} has no primary key to find duplicates'.format(self.schema, layer))
+
+        before_commit = None
+        if self.journal:
+            before_commit = lambda cur, counts: self._record(cur, layer, counts)
+
+        if self.changes is not None:
+            return self._load_changes(layer, source_layer, table_info, progress, before_commit)
+
+        con = self._pool.getconn()
+        try:
+            if self.action == NO_ACTION:
+                rows = copy_layer(con, source_layer, self.schema, table_info, self.feedback, progress, total,
+                                  before_commit)
+                return None if rows is None else LoadCounts(rows, 0, 0, 0)
+            return merge_layer(con, source_layer, self.schema, table_info, key,
+                               self.action == UPDATE_EXISTING_FEATURE, self.feedback, progress, total, before_commit)
+        finally:
+            self._pool.putconn(con)
+
+    def _load_changes(self, layer, source_layer, table_info, progress, before_commit):
+        changes = self.changes.get(layer, LayerChanges(0, 0, [], [], None))
+        fid_column = source_layer.GetFIDColumn()
+        if not fid_column or fid_column not in table_info.columns:
+            raise ValueError('The FID column of layer {} is not a column of the table'.format(layer))
+        if changes.source is None and (changes.inserted or changes.discarded):
+            raise ValueError('The change log of layer {} has no source id'.format(layer))
+
+        # The geopackage driver hands the filter to SQLite, subquery included
+        log_filter = "{} IN (SELECT fid FROM {} WHERE table_name = {} AND operation = '{{}}')".format(
+            quote_ident(fid_column), CHANGELOG_TABLE, sql_literal(layer))
+        middle = progress[0] + (progress[1] - progress[0]) * changes.updated // max(changes.inserted + changes.updated, 1)
+
+        # Updates, inserts and deletes in a single transaction
+        def work(cur):
+            source_layer.SetAttributeFilter(log_filter.format('U'))
+            counts = merge_rows(cur, source_layer, self.schema, table_info, [fid_column], True, self.feedback,
+                                (progress[0], middle), changes.updated, changes.deleted)
+            source_layer.SetAttributeFilter(log_filter.format('I'))
+            replayed = replay_rows(cur, source_layer, self.schema, table_info, changes.source, self.feedback,
+                                   (middle, progress[1]), changes.inserted, changes.discarded)
+            counts = LoadCounts(*(a + b for a, b in zip(counts, replayed)))
+            if before_commit is not None:
+                before_commit(cur, counts)
+            return counts
+
+        con = self._pool.getconn()
+        try:
+            return copy_transaction(con, self.feedback, work)
+        finally:
+            self._pool.putconn(con)
+            source_layer.SetAttributeFilter(None)
+
+    def _create_imported_table(self):
+        con = self._pool.getconn()
+        try:
+            with con:
+                cur = con.cursor()
+                cur.execute('CREATE TABLE IF NOT EXISTS {} (source text, table_name text, fid bigint, key text, '
+                            'imported_at timestamptz DEFAULT now(), PRIMARY KEY (source, table_name, fid))'.format(
+                                quote_table(self.schema, IMPORTED_TABLE)))
+                cur.close()
+        finally:
+            self._pool.putconn(con)
+
+    def _journal_table(self, parameters=False):
+        return quote_table(self.schema, JOURNAL_TABLE, parameters)
+
+    def _record(self, cur, layer, counts):
+        cur.execute('INSERT INTO {} (file_hash, layer, inserted, updated, skipped, deleted) VALUES (%s, %s, %s, %s, %s, %s) '
+                    'ON CONFLICT (file_hash, layer) DO UPDATE SET inserted = EXCLUDED.inserted, '
+                    'updated = EXCLUDED.updated, skipped = EXCLUDED.skipped, deleted = EXCLUDED.deleted, imported_at = now()'.format(
+                        self._journal_table(True)), (self.journal, layer) + tuple(counts))
+
+    def completed_layers(self):
+        '''Layers of the journal already loaded, creating the journal table if needed.'''
+        con = self._pool.getconn()
+        try:
+            with con:
+                cur = con.cursor()
+                cur.execute('CREATE TABLE IF NOT EXISTS {} (file_hash text, layer text, inserted bigint, updated bigint, '
+                            'skipped bigint, deleted bigint, imported_at timestamptz DEFAULT now(), '
+                            'PRIMARY KEY (file_hash, layer))'.format(self._journal_table()))
+                cur.execute('SELECT layer FROM {} WHERE file_hash = %s'.format(self._journal_table(True)),
+                            (self.journal,))
+                layers = {row[0] for row in cur.fetchall()}
+                cur.close()
+        finally:
+            self._pool.putconn(con)
+        return layers
+
+    def _suspended_table(self, parameters=False):
+        return quote_table(self.schema, SUSPENDED_TABLE, parameters)
+
+    def suspend(self, tables):
+        '''Drop the indexes (except the unique, exclusion and constraint ones) and disable the user
+           triggers of tables, recording them in the suspended table of the schema
+           in the same transaction, so they can be restored even after a failure.
+           Return the number of indexes and triggers suspended.'''
+        suspended_table = self._suspended_table()
+        con = self._pool.getconn()
+        try:
+            with con:
+                cur = con.cursor()
+                cur.execute('CREATE TABLE IF NOT EXISTS {} (table_name text, kind text, name text, definition text, '
+                            'PRIMARY KEY (table_name, kind, name))'.format(suspended_table))
+                cur.execute(SUSPENDABLE_QUERY, (self.schema, list(tables), self.schema, list(tables)))
+                objects = cur.fetchall()
+                for table, kind, name, definition in objects:
+                    cur.execute('INSERT INTO {} VALUES (%s, %s, %s, %s)'.format(self._suspended_table(True)),
+                                (table, kind, name, definition))
+                    if kind == 'index':
+                        cur.execute('DROP INDEX {}'.format(quote_table(self.schema, name)))
+                    else:
+                        cur.execute('ALTER TABLE {} DISABLE TRIGGER {}'.format(quote_table(self.schema, table),
+                                                                              quote_ident(name)))
+                cur.close()
+        finally:
+            self._pool.putconn(con)
+        return len(objects)
+
+    def _restore(self, table, kind, name, definition):
+        con = self._pool.getconn()
+        try:
+            with con:
+                cur = con.cursor()
+                if kind == 'index':
+                    cur.execute(definition)
+                else:
+                    cur.execute('ALTER TABLE {} ENABLE TRIGGER {}'.format(quote_table(self.schema, table),
+                                                                         quote_ident(name)))
+                cur.execute('DELETE FROM {} WHERE table_name = %s AND kind = %s AND name = %s'.format(
+                    self._suspended_table(True)), (table, kind, name))
+                cur.close()
+        finally:
+            self._pool.putconn(con)
+
+    def restore(self, workers=1):
+        '''Rebuild the indexes and enable the triggers recorded in the suspended
+           table of the schema, workers indexes at a time, largest tables first.
+
+           Each object is restored and removed from the table in its own
+           transaction, so the objects that fail stay recorded and are restored
+           by the next bulk load. Return {object: error message}.'''
+        con = self._pool.getconn()
+        try:
+            with con:
+                cur = con.cursor()
+                cur.execute('SELECT to_regclass(%s)', (self._suspended_table(),))
+                objects = []
+                if cur.fetchone()[0] is not None:
+                    cur.execute('SELECT table_name, kind, name, definition FROM {}'.format(self._suspended_table()))
+                    objects = cur.fetchall()
+                cur.close()
+        finally:
+            self._pool.putconn(con)
+
+        # Triggers are enabled in a moment, the indexes take the time. Unlike run_concurrently, a cancel
+        # doesn't stop the restore, which must leave the tables whole
+        sizes = self.catalog.sizes()
+        objects.sort(key=lambda o: (o[1] != 'trigger', -sizes.get(o[0], 0)))
+        errors = dict()
+
+        def timed_restore(suspended):
+            start = time.perf_counter()
+            self._restore(*suspended)
+            return time.perf_counter() - start
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(timed_restore, suspended): suspended for suspended in objects}
+            for future in as_completed(futures):
+                table, kind, name, definition = futures[future]
+                try:
+                    seconds = future.result()
+                    self.feedback.pushInfo('Restored {} {} of {}.{} in {:.1f} s'.format(kind, name, self.schema, table, seconds))
+                except Exception as e:
+                    errors[name] = str(e)
+                    self.feedback.reportError('{} {} of {}.{} not restored: {}'.format(kind, name, self.schema, table, e))
+        return errors
+
+    def analyze(self, tables):
+        '''Update the statistics of tables.'''
+        con = self._pool.getconn()
+        try:
+            with con:
+                cur = con.cursor()
+                for table in tables:
+                    cur.execute('ANALYZE {}'.format(quote_table(self.schema, table)))
+                cur.close()
+        finally:
+            self._pool.putconn(con)
+
+    def close(self):
+        '''Close the connections and the datasets opened by every thread.'''
+        self._pool.closeall()
+        with self._lock:
+            self._datasets = []
+        self._local = threading.local()
+
+
+class CopyWriter:
+    '''Append QGIS features to a PostGIS table with COPY, out of the edit
+       buffer of the layer.
+
+       line() turns the attributes and the geometry of a feature into a line of
+       COPY, and write() sends lines in a transaction of their own.
+
+       The values of the default columns (a serial key) are copied when given,
+       the rows where one of them is NULL being copied without them, so that
+       the database assigns them.'''
+
+    def __init__(self, con, schema, table, columns, geometry_column=None, srid=0, default_columns=()):
+        '''columns are the (field index, column name) of the attributes copied, the
+           other columns get their default values. default_columns are the field
+           indexes of the columns whose NULL values are left to their default.'''
+        self.con = con
+        self.columns = columns
+        self.geometry_column = geometry_column
+        self.srid = srid
+        self.default_columns = [index for index, name in columns if index in default_columns]
+        table = quote_table(schema, table) if schema else quote_ident(table)
+        geometry = [geometry_column] if geometry_column else []
+        self.copy_sql = [self._copy_sql(table, [name for index, name in columns] + geometry),
+                         self._copy_sql(table, [name for index, name in columns if index not in self.default_columns] + geometry)]
+
+    @staticmethod
+    def _copy_sql(table, names):
+        return 'COPY {} ({}) FROM STDIN'.format(table, ', '.join(quote_ident(name) for name in names))
+
+    def line(self, attrs, geometry=None):
+        '''(whether the default columns are left out, line of COPY) of a feature, attrs being {field index: value}.'''
+        defaulted = any(attrs.get(index) is None or attrs.get(index) == NULL for index in self.default_columns)
+        values = [qgs_copy_value(attrs.get(index)) for index, name in self.columns
+                  if not (defaulted and index in self.default_columns)]
+        if self.geometry_column:
+            values.append('\\N' if geometry is None or geometry.isNull() else qgs_ewkb_hex(geometry, self.srid))
+        return defaulted, '\t'.join(values) + '\n'
+
+    def write(self, lines):
+        '''COPY lines in one transaction, rolled back on error. Return the number of rows copied.'''
+        rowcount = 0
+        with self.con:
+            cur = self.con.cursor()
+            for defaulted in (False, True):
+                copied = [line for line_defaulted, line in lines if line_defaulted == defaulted]
+                if copied:
+                    cur.copy_expert(self.copy_sql[defaulted], CopyStream(copied))
+                    rowcount += cur.rowcount
+            cur.close()
+        return rowcount
+
+    def close(self):
+        self.con.close()
+
+
+def import_layers_concurrently(loader, layers, workers, progress=(0, 100), weights=None):
+    '''Load each layer with the loader, workers layers at a time, in the order
+       of layers (see run_concurrently).
+
+       The time and the counts of each layer are reported. Return
+       ({layer: LoadCounts}, {layer: error message}), without the layers whose
+       load was canceled.'''
+    feedback = loader.feedback
+
+    def done(layer, loaded, seconds):
+        if loaded is not None:
+            feedback.pushInfo('Imported {}.{}: {} in {:.1f} s'.format(loader.schema, layer, format_counts(loaded), seconds))
+
+    def failed(layer, e):
+        feedback.reportError('Layer {}.{} not imported: {}'.format(loader.schema, layer, e))
+
+    counts, errors = run_concurrently(layers, lambda layer: loader.load(layer, None), workers, feedback, progress,
+                                      weights, done, failed)
+    return {layer: loaded for layer, loaded in counts.items() if loaded is not None}, errors
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+
+"""
+***************************************************************************
+*                                                                         *
+*   This program is free software; you can redistribute it and/or modify  *
+*   it under the terms of the GNU General Public License as published by  *
+*   the Free Software Foundation; either version 2 of the License, or     *
+*   (at your option) any later version.                                   *
+*                                                                         *
+***************************************************************************
+"""
+
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+
+
+def run_concurrently(items, fn, workers, feedback, progress=(0, 100), weights=None, done=None, failed=None):
+    '''Call fn(item) for each item, workers items at a time, in the order of
+       items (largest first keeps the workers balanced).
+
+       An item that fails doesn't stop the others and, when the feedback is
+       canceled, the pending items aren't run. done(item, result, seconds) and
+       failed(item, exception) are called in the calling thread as each item
+       ends, for example to report it. The progress of each item is
+       proportional to its weight ({item: weight}, for example its size).
+       Return ({item: result}, {item: error message}).'''
+    results = dict()
+    errors = dict()
+    weights = {item: max(weights.get(item, 0), 1) if weights else 1 for item in items}
+    total_weight = float(sum(weights.values()))
+    done_weight = 0
+
+    def timed(item):
+        start = time.perf_counter()
+        return fn(item), time.perf_counter() - start
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(timed, item): item for item in items}
+
+        for future in as_completed(futures):
+            if feedback.isCanceled():
+                for pending in futures:
+                    pending.cancel()
+                break
+            item = futures[future]
+            try:
+                results[item], seconds = future.result()
+                if done is not None:
+                    done(item, results[item], seconds)
+            except Exception as e:
+                errors[item] = str(e)
+                if failed is not None:
+                    failed(item, e)
+            done_weight += weights[item]
+            feedback.setProgress(progress[0] + int((progress[1] - progress[0]) * done_weight / total_weight))
+
+    return results, errors
@@ -0,0 +1,566 @@
+# -*- coding: utf-8 -*-
+
+"""
+***************************************************************************
+*                                                                         *
+*   This program is free software; you can redistribute it and/or modify  *
+*   it under the terms of the GNU General Public License as published by  *
+*   the Free Software Foundation; either version 2 of the License, or     *
+*   (at your option) any later version.                                   *
+*                                                                         *
+***************************************************************************
+"""
+
+from qgis.core import (QgsProcessingException,
+                       QgsProcessingParameterBoolean,
+                       QgsProcessingParameterString,
+                       QgsGeometry)
+
+import glob
+import hashlib
+import os
+import shutil
+import sqlite3 as lite
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+from osgeo import gdal
+
+from .concurrency import run_concurrently
+from .schema_introspection import quote_ident, quote_table
+
+
+# Table of the geopackage with the fingerprint of each exported table
+MANIFEST_TABLE = 'publibase_manifest'
+
+# Table of the geopackage where triggers log the edited features of each layer
+CHANGELOG_TABLE = 'publibase_changelog'
+
+# Table of the geopackage with a random id of each layer copy, set by the first feature inserted in it
+CHANGELOG_SOURCE_TABLE = 'publibase_changelog_source'
+
+# Help of the table selection parameters of the exports
+TABLE_SELECTION_HELP = ("The tables can be selected with comma separated patterns (for example hid_*, tra_*) "
+                        "and the empty tables can be skipped. The tables are exported largest first.")
+
+# Fast write profile for geopackages: big transactions, spatial index built after the data
+# and no SQLite journal or fsync while the file is built
+FAST_WRITE_OPTIONS = ['-gt', '65536', '-lco', 'SPATIAL_INDEX=NO']
+FAST_WRITE_CONFIG = {'OGR_SQLITE_JOURNAL': 'OFF',
+                     'OGR_SQLITE_SYNCHRONOUS': 'OFF',
+                     'OGR_SQLITE_CACHE': '512'}
+
+
+def pg_connection_string(uri, schema):
+    '''OGR connection string to the PostGIS database, restricted to schema.'''
+    return 'PG:host={} dbname={} schemas={} port={} user={} password={}'.format(uri.host(), uri.database(), schema,
+                                                                               uri.port(), uri.username(), uri.password())
+
+
+def table_fingerprints(catalog, options='', tables=None):
+    '''Return {table: (row count, fingerprint)} for the exportable relations of
+       the schema catalog (only the tables names, if given).
+
+       The fingerprint hashes the table storage (relfilenode, changed by TRUNCATE),
+       the insert/update/delete counters of pg_stat_user_tables, the column
+       definitions and the export options, so it changes whenever the exported
+       content of the table may have changed. Partitioned tables, views,
+       materialized views and foreign tables have no counters of their own
+       and always get a new fingerprint.'''
+    fingerprints = dict()
+    for table in catalog.exportable_tables():
+        if tables is not None and table.name not in tables:
+            continue
+        parts = [table.relfilenode, table.modifications, list(zip(table.columns, table.column_types)), options]
+        if table.kind != 'r':
+            parts.append(time.time())
+        fingerprints[table.name] = (table.live_rows or 0, hashlib.md5(repr(parts).encode('utf-8')).hexdigest())
+    return fingerprints
+
+
+def dataset_signature(path):
+    '''md5 of the content of a file dataset and of its sidecar files (the
+       .shx, .dbf, .prj... of a shapefile), so it changes whenever the
+       dataset is edited, even if its path doesn't.'''
+    digest = hashlib.md5()
+    for name in sorted(glob.glob(glob.escape(os.path.splitext(path)[0]) + '.*')):
+        digest.update(os.path.basename(name).encode('utf-8'))
+        with open(name, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                digest.update(block)
+    return digest.hexdigest()
+
+
+def read_manifest(geopackage):
+    '''Return {table: fingerprint} stored in the manifest of the geopackage,
+       empty if the geopackage or its manifest doesn't exist.'''
+    if not os.path.isfile(geopackage):
+        return dict()
+
+    with lite.connect(geopackage) as con:
+        cur = con.cursor()
+        cur.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = ?", (MANIFEST_TABLE,))
+        if cur.fetchone() is None:
+            return dict()
+        cur.execute("SELECT table_name, fingerprint FROM {}".format(MANIFEST_TABLE))
+        return {row[0]: row[1] for row in cur.fetchall()}
+
+
+def write_manifest(geopackage, fingerprints, removed=()):
+    '''Store the {table: (row count, fingerprint)} of the exported tables in the
+       manifest of the geopackage and forget the removed tables.
+
+       The manifest is a plain table, not registered in gpkg_contents, so it
+       isn't listed as a layer.'''
+    exported_at = datetime.now().isoformat(timespec='seconds')
+    with lite.connect(geopackage) as con:
+        cur = con.cursor()
+        cur.execute("CREATE TABLE IF NOT EXISTS {} (table_name TEXT PRIMARY KEY, row_count INTEGER, "
+                    "fingerprint TEXT, exported_at TEXT)".format(MANIFEST_TABLE))
+        cur.executemany("INSERT OR REPLACE INTO {} VALUES (?, ?, ?, ?)".format(MANIFEST_TABLE),
+                        [(table, row_count, fingerprint, exported_at) for table, (row_count, fingerprint) in fingerprints.items()])
+        cur.executemany("DELETE FROM {} WHERE table_name = ?".format(MANIFEST_TABLE), [(table,) for table in removed])
+
+
+def plan_incremental_export(catalog, geopackage, feedback, options='', tables=None):
+    '''Compare the fingerprints of the schema tables (only the tables names, if
+       given) with the manifest of the geopackage.
+
+       Return (fingerprints of the changed tables, tables removed from the schema
+       or from the selected tables).'''
+    fingerprints = table_fingerprints(catalog, options, tables)
+    manifest = read_manifest(geopackage)
+
+    changed = {table: value for table, value in fingerprints.items() if manifest.get(table) != value[1]}
+    removed = [table for table in manifest if table not in fingerprints]
+
+    feedback.pushInfo('Changed tables = ' + str(sorted(changed)))
+    feedback.pushInfo('Unchanged tables = {}'.format(len(fingerprints) - len(changed)))
+    if removed:
+        feedback.pushInfo('Tables removed from the schema = ' + str(removed))
+
+    return changed, removed
+
+
+def begin_incremental_export(catalog, geopackage, tables, feedback, options=''):
+    '''Plan the incremental export of tables to the geopackage (see
+       plan_incremental_export) and drop the layers of the removed tables.
+
+       Return (fingerprints of the changed tables, removed tables, tables to
+       export, largest first). When no table changed, the removed tables are
+       already forgotten by the manifest and there is nothing to export.'''
+    changed, removed = plan_incremental_export(catalog, geopackage, feedback, options, tables)
+    drop_layers(geopackage, removed)
+    if not changed and removed:
+        write_manifest(geopackage, changed, removed)
+    return changed, removed, [table for table in tables if table in changed]
+
+
+def sql_literal(value):
+    '''Quote a SQL string literal.'''
+    return "'" + value.replace("'", "''") + "'"
+
+
+def install_changelog(geopackage, layers=None):
+    '''Log the edits of the feature layers of the geopackage (all, if layers is None).
+
+       Triggers of each layer keep the last operation of each edited feature
+       in the change log: 'I' for a feature inserted since the export (even if
+       updated later), 'U' for a feature of the export updated, 'D' for a
+       feature of the export deleted and 'X' for a feature inserted then
+       deleted, which a previous import of the geopackage may have loaded.
+       The first feature inserted in a layer gives the layer a random source
+       id, so the imports of a copy of the geopackage can tell the features
+       they already loaded from the ones of another copy. The log of the
+       layers is cleared, since they are a fresh copy of the schema. Like the
+       manifest, the change log isn't registered in gpkg_contents.'''
+    con = lite.connect(geopackage)
+    try:
+        with con:
+            cur = con.cursor()
+            cur.execute("CREATE TABLE IF NOT EXISTS {} (table_name TEXT, fid INTEGER, operation TEXT, "
+                        "PRIMARY KEY (table_name, fid)) WITHOUT ROWID".format(CHANGELOG_TABLE))
+            cur.execute("CREATE TABLE IF NOT EXISTS {} (table_name TEXT PRIMARY KEY, source TEXT)".format(
+                CHANGELOG_SOURCE_TABLE))
+            cur.execute("SELECT table_name FROM gpkg_contents WHERE data_type = 'features'")
+            names = [row[0] for row in cur.fetchall() if layers is None or row[0] in layers]
+            for name in names:
+                cur.execute('PRAGMA table_info({})'.format(quote_ident(name)))
+                fid = [quote_ident(row[1]) for row in cur.fetchall() if row[5] == 1]
+                if len(fid) != 1:
+                    continue
+                fid = fid[0]
+                cur.execute("DELETE FROM {} WHERE table_name = ?".format(CHANGELOG_TABLE), (name,))
+                cur.execute("DELETE FROM {} WHERE table_name = ?".format(CHANGELOG_SOURCE_TABLE), (name,))
+
+                parts = dict(log=CHANGELOG_TABLE, source=CHANGELOG_SOURCE_TABLE, table=sql_literal(name), fid=fid)
+                inserted = ("EXISTS (SELECT 1 FROM {log} WHERE table_name = {table} AND fid = OLD.{fid} "
+                            "AND operation = 'I')").format(**parts)
+                parts.update(inserted=inserted)
+                source = "INSERT OR IGNORE INTO {source} SELECT {table}, lower(hex(randomblob(16)))".format(**parts)
+                insert = "INSERT OR REPLACE INTO {log} VALUES ({table}, NEW.{fid}, 'I');".format(**parts)
+                # An inserted feature stays inserted, and a changed fid is a new feature
+                update = ("INSERT OR REPLACE INTO {log} SELECT {table}, NEW.{fid}, "
+                          "CASE WHEN OLD.{fid} IS NOT NEW.{fid} OR {inserted} THEN 'I' ELSE 'U' END;").format(**parts)
+                # Deleted from the schema if it was exported, or loaded by a previous import
+                delete = ("INSERT OR REPLACE INTO {log} SELECT {table}, OLD.{fid}, "
+                          "CASE WHEN {inserted} THEN 'X' ELSE 'D' END;").format(**parts)
+                # A changed fid is the deletion of the old feature
+                moved = ("INSERT OR REPLACE INTO {log} SELECT {table}, OLD.{fid}, "
+                         "CASE WHEN {inserted} THEN 'X' ELSE 'D' END WHERE OLD.{fid} IS NOT NEW.{fid};").format(**parts)
+                triggers = {'insert': ('AFTER INSERT', source + '; ' + insert),
+                            'update': ('AFTER UPDATE', source + ' WHERE OLD.{fid} IS NOT NEW.{fid}; '.format(**parts)
+                                       + update + ' ' + moved),
+                            'delete': ('AFTER DELETE', delete)}
+                for operation, (event, body) in triggers.items():
+                    trigger = quote_ident('{}_{}_{}'.format(CHANGELOG_TABLE, operation, name))
+                    cur.execute('DROP TRIGGER IF EXISTS {}'.format(trigger))
+                    cur.execute('CREATE TRIGGER {} {} ON {} BEGIN {} END'.format(trigger, event, quote_ident(name), body))
+            cur.close()
+    finally:
+        con.close()
+    return names
+
+
+def drop_layers(geopackage, layers):
+    '''Drop layers from the geopackage, with their geopackage metadata.'''
+    if not layers or not os.path.isfile(geopackage):
+        return
+
+    dataset = gdal.OpenEx(geopackage, gdal.OF_VECTOR | gdal.OF_UPDATE)
+    for layer in layers:
+        for i in range(dataset.GetLayerCount()):
+            if dataset.GetLayer(i).GetName() == layer:
+                dataset.DeleteLayer(i)
+                break
+    dataset = None
+
+
+def export_options(output_format, clip=None, extra=()):
+    '''ogr2ogr arguments shared by the exports, for any OGR output format.
+
+       clip is the path of a shapefile used to clip the features and extra are
+       further ogr2ogr arguments (layer creation options, spatial filter...).'''
+    options = ['-f', output_format, '-overwrite']
+    options.extend(extra)
+    if clip:
+        options.extend(['-clipsrc', clip])
+    return options
+
+
+def add_table_selection_parameters(algorithm):
+    '''Add the parameters selecting the tables to export (INCLUDE_TABLES,
+       EXCLUDE_TABLES and SKIP_EMPTY of the algorithm) to a processing algorithm.'''
+    algorithm.addParameter(QgsProcessingParameterString(algorithm.INCLUDE_TABLES,
+                                                        algorithm.tr('Tables to export (comma separated patterns, e.g. hid_*, tra_*)'),
+                                                        '', False, True))
+    algorithm.addParameter(QgsProcessingParameterString(algorithm.EXCLUDE_TABLES,
+                                                        algorithm.tr('Tables not to export (comma separated patterns)'),
+                                                        '', False, True))
+    algorithm.addParameter(QgsProcessingParameterBoolean(algorithm.SKIP_EMPTY, algorithm.tr('Skip empty tables'),
+                                                         False, optional=True))
+
+
+def selected_tables(algorithm, parameters, context, catalog, feedback):
+    '''Exportable relations of the schema catalog (see
+       SchemaCatalog.exportable_tables) selected by the table selection
+       parameters of the algorithm (see add_table_selection_parameters),
+       largest first.
+
+       Every export mode is given this list, so the serial, parallel,
+       incremental and server clipped exports write the same layers, in the
+       same order.'''
+    include_tables = algorithm.parameterAsString(parameters, algorithm.INCLUDE_TABLES, context)
+    exclude_tables = algorithm.parameterAsString(parameters, algorithm.EXCLUDE_TABLES, context)
+    skip_empty = algorithm.parameterAsBool(parameters, algorithm.SKIP_EMPTY, context)
+
+    tables = catalog.select_tables(include_tables, exclude_tables, skip_empty, exportable=True)
+    feedback.pushInfo('Selected tables = {}'.format(len(tables)))
+    if not tables:
+        feedback.pushInfo('No tables to export')
+    return tables
+
+
+def clip_geometry(clip_layer):
+    '''Return (hex WKB, PostGIS SRID) of the union of the features of the clip layer.'''
+    geometry = QgsGeometry.unaryUnion([f.geometry() for f in clip_layer.getFeatures() if f.hasGeometry()])
+    if geometry.isNull():
+        raise QgsProcessingException('The clip layer has no geometry')
+    return bytes(geometry.asWkb()).hex(), clip_layer.crs().postgisSrid()
+
+
+def server_clip_queries(catalog, clip_layer, keep_fid=False):
+    '''Return {table: (query, ogr2ogr options)} extracting every exportable
+       relation of the schema catalog clipped by the clip layer on the PostGIS
+       server.
+
+       Only features intersecting the clip polygon are read (the && operator
+       of ST_Intersects uses the GiST index) and only the features crossing
+       its boundary are cut with ST_Intersection, keeping the geometry type of
+       the table. Tables without geometry get a None query and are exported
+       whole. OGR can't tell the geometry type of a query, so the layer of each
+       query gets the type of the table, with its Z/M suffix (-nlt). With
+       keep_fid, the single column primary key is kept as the FID column
+       (-lco FID), as in a plain export to geopackage.'''
+    clip_wkb, clip_srid = clip_geometry(clip_layer)
+    schema = catalog.schema
+
+    queries = dict()
+    for info in catalog.exportable_tables():
+        table, geom_column, srid, geom_type, pk = info.name, info.geometry_column, info.srid, info.geometry_type, info.primary_key
+        # Only the first geometry column is clipped
+        columns = [column for column in info.columns if column != geom_column]
+
+        layer_options = ['-lco', 'FID=' + pk[0]] if keep_fid and len(pk) == 1 else []
+        if geom_column is None:
+            queries[table] = (None, layer_options)
+            continue
+
+        clip = "ST_SetSRID(ST_GeomFromWKB(decode('{}', 'hex')), {})".format(clip_wkb, clip_srid)
+        if srid and clip_srid and srid != clip_srid:
+            clip = "ST_Transform({}, {})".format(clip, srid)
+
+        # Keep the geometry type of the table
+        geom_type = geom_type.upper()
+        layer_options += ['-nlt', geom_type]
+        g = 't.' + quote_ident(geom_column)
+        intersection = "ST_Intersection({}, c.geom)".format(g)
+        for name, dimension in (('POLYGON', 3), ('LINESTRING', 2), ('POINT', 1)):
+            if name in geom_type:
+                intersection = "ST_CollectionExtract({}, {})".format(intersection, dimension)
+                break
+        if geom_type.startswith('MULTI'):
+            intersection = "ST_Multi({})".format(intersection)
+
+        select_columns = ['t.' + quote_ident(column) for column in columns]
+        select_columns.append("CASE WHEN ST_CoveredBy({0}, c.geom) THEN {0} ELSE {1} END AS {2}".format(g, intersection, quote_ident(geom_column)))
+        query = ("SELECT * FROM (SELECT {} FROM {} t, (SELECT {} AS geom) c WHERE ST_Intersects({}, c.geom)) q "
+                 "WHERE NOT ST_IsEmpty(q.{})").format(', '.join(select_columns), quote_table(schema, table),
+                                                       clip, g, quote_ident(geom_column))
+        queries[table] = (query, layer_options)
+
+    return queries
+
+
+@contextmanager
+def gdal_config(config=None):
+    '''Set GDAL configuration options for the current thread only, restoring them at exit.'''
+    config = config or dict()
+    previous = {key: gdal.GetThreadLocalConfigOption(key, None) for key in config}
+    for key, value in config.items():
+        gdal.SetThreadLocalConfigOption(key, value)
+    try:
+        yield
+    finally:
+        for key, value in previous.items():
+            gdal.SetThreadLocalConfigOption(key, value)
+
+
+def report_time(feedback, phase, start):
+    '''Report the time spent in a phase started at start (time.perf_counter()).'''
+    feedback.pushInfo('Time of {}: {:.1f} s'.format(phase, time.perf_counter() - start))
+
+
+def vector_translate(destination, source, options, feedback, layers=None, progress=(0, 100), config=None):
+    '''Run gdal.VectorTranslate (in-process ogr2ogr) from source to destination.
+
+       destination and source are paths, connection strings or open datasets.
+       The progress of the translation is reported as the range progress of the
+       feedback (None doesn't report it) and the translation stops as soon as the
+       feedback is canceled. config are GDAL configuration options used during
+       the translation. Return False if canceled, raise QgsProcessingException
+       with the GDAL error if the translation fails.'''
+    def callback(complete, message, data):
+        if progress is not None:
+            feedback.setProgress(progress[0] + int(complete * (progress[1] - progress[0])))
+        return 0 if feedback.isCanceled() else 1
+
+    translate_options = gdal.VectorTranslateOptions(options=options, layers=layers, callback=callback)
+    with gdal_config(config):
+        result = gdal.VectorTranslate(destination, source, options=translate_options)
+    if result is None:
+        if feedback.isCanceled():
+            return False
+        raise QgsProcessingException(gdal.GetLastErrorMsg())
+
+    # Dereferencing the dataset flushes and closes it, unless the caller holds it
+    result = None
+    return True
+
+
+class ExportEngine:
+    '''Export layers of a PostGIS schema in-process with gdal.VectorTranslate.
+
+       The schema datasource is opened once per thread and reused by every layer
+       exported from that thread, so a serial export opens a single connection
+       and a pool of workers opens one connection per worker.
+
+       With queries ({table: (query, ogr2ogr options)}, see server_clip_queries),
+       each table is extracted by its own query over the same datasource.
+       config are GDAL configuration options used by every export.'''
+
+    def __init__(self, uri, schema, feedback, queries=None, config=None):
+        self.uri = uri
+        self.schema = schema
+        self.feedback = feedback
+        self.queries = queries
+        self.config = config
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._sources = []
+
+    def source(self):
+        '''Schema datasource of the current thread.'''
+        source = getattr(self._local, 'source', None)
+        if source is None:
+            source = gdal.OpenEx(pg_connection_string(self.uri, self.schema), gdal.OF_VECTOR)
+            if source is None:
+                raise QgsProcessingException('Could not open schema {}: {}'.format(self.schema, gdal.GetLastErrorMsg()))
+            self._local.source = source
+            with self._lock:
+                self._sources.append(source)
+        return source
+
+    def export(self, destination, options, layers=None, progress=(0, 100)):
+        '''Export the layers (all the schema, if None) to destination.'''
+        if self.queries is None:
+            return vector_translate(destination, self.source(), options, self.feedback, layers, progress, self.config)
+
+        if layers is None:
+            layers = list(self.queries)
+        for current, layer in enumerate(layers):
+            layer_progress = None
+            if progress is not None:
+                step = (progress[1] - progress[0]) / len(layers)
+                layer_progress = (progress[0] + int(current * step), progress[0] + int((current + 1) * step))
+
+            query, layer_options = self.queries[layer]
+            if query is None:
+                exported = vector_translate(destination, self.source(), list(options) + layer_options, self.feedback, [layer],
+                                            layer_progress, self.config)
+            else:
+                exported = vector_translate(destination, self.source(), list(options) + layer_options + ['-sql', query, '-nln', layer],
+                                            self.feedback, None, layer_progress, self.config)
+            if not exported:
+                return False
+        return True
+
+    def close(self):
+        '''Close the datasources opened by every thread.'''
+        with self._lock:
+            self._sources = []
+        self._local = threading.local()
+
+
+def export_tables_concurrently(engine, tables, destination, options, workers, progress=(0, 100), weights=None):
+    '''Export each table with its own call of the engine, workers tables at a time,
+       in the order of tables (see run_concurrently).
+
+       destination(table) is the destination of each table. Return
+       {table: error message} of the failed tables.'''
+    feedback = engine.feedback
+
+    def done(table, exported, seconds):
+        if exported:
+            feedback.pushInfo('Exported {}.{}'.format(engine.schema, table))
+
+    def failed(table, e):
+        feedback.reportError('Table {}.{} not exported: {}'.format(engine.schema, table, e))
+
+    return run_concurrently(tables, lambda table: engine.export(destination(table), options, [table], None),
+                            workers, feedback, progress, weights, done, failed)[1]
+
+
+def export_schema_parallel(catalog, geopackage, workers, feedback, options=(), only_tables=None, queries=None,
+                           merge_options=('-overwrite',), config=None):
+    '''Export every exportable relation of the schema catalog (or only_tables,
+       if given) to the geopackage using a pool of workers, largest tables first.
+
+       Each worker extracts one table at a time into a temporary geopackage.
+       When all the tables are extracted, the temporary geopackages are merged
+       into the final geopackage. options are the ogr2ogr arguments (for
+       example the -clipsrc) used in every extraction, queries are the per
+       table extraction queries of the ExportEngine, merge_options are the
+       ogr2ogr arguments of the merge and config the GDAL configuration options
+       of the extraction and of the merge.'''
+    tables = [table.name for table in catalog.exportable_tables()]
+    if only_tables is not None:
+        tables = [table for table in tables if table in only_tables]
+    feedback.pushInfo('Tables (largest first) = ' + str(tables))
+    if not tables:
+        return []
+
+    engine = ExportEngine(catalog.uri, catalog.schema, feedback, queries, config)
+    temp_folder = tempfile.mkdtemp(prefix='publibase_', dir=os.path.dirname(os.path.abspath(geopackage)))
+
+    try:
+        # Extraction: one table per worker at a time, the first 80 % of the job
+        errors = export_tables_concurrently(engine, tables,
+                                            lambda table: os.path.join(temp_folder, table + '.gpkg'),
+                                            options, workers, (0, 80), catalog.sizes())
+        engine.close()
+
+        if errors:
+            raise QgsProcessingException('\n'.join('{}: {}'.format(table, error) for table, error in errors.items()))
+        if feedback.isCanceled():
+            return []
+        parts = {table: os.path.join(temp_folder, table + '.gpkg') for table in tables}
+
+        # Merge: sequential, since a geopackage has a single writer, into the destination opened once
+        feedback.pushInfo('Merging {} tables into {}'.format(len(parts), geopackage))
+        with gdal_config(config):
+            if os.path.isfile(geopackage):
+                destination = gdal.OpenEx(geopackage, gdal.OF_VECTOR | gdal.OF_UPDATE)
+            else:
+                destination = gdal.GetDriverByName('GPKG').Create(geopackage, 0, 0, 0, gdal.GDT_Unknown)
+            if destination is None:
+                raise QgsProcessingException(gdal.GetLastErrorMsg())
+
+            for current, table in enumerate(tables):
+                if not vector_translate(destination, parts[table], list(merge_options), feedback, [table], None):
+                    break
+                feedback.setProgress(80 + int(20.0 * (current + 1) / len(tables)))
+            destination = None
+    finally:
+        engine.close()
+        shutil.rmtree(temp_folder, ignore_errors=True)
+
+    return tables
+
+
+def finish_fast_write(geopackage, feedback):
+    '''Finish a geopackage written with the fast write profile.
+
+       Create the spatial indexes missing in its layers, then run ANALYZE
+       and VACUUM, reporting the time of each phase.'''
+    start = time.perf_counter()
+    with gdal_config(FAST_WRITE_CONFIG):
+        dataset = gdal.OpenEx(geopackage, gdal.OF_VECTOR | gdal.OF_UPDATE)
+        for i in range(dataset.GetLayerCount()):
+            if feedback.isCanceled():
+                break
+            layer = dataset.GetLayer(i)
+            geom_column = layer.GetGeometryColumn()
+            if not geom_column:
+                continue
+            result = dataset.ExecuteSQL("SELECT HasSpatialIndex('{}', '{}')".format(layer.GetName(), geom_column))
+            has_index = result.GetNextFeature().GetField(0)
+            dataset.ReleaseResultSet(result)
+            if not has_index:
+                result = dataset.ExecuteSQL("SELECT CreateSpatialIndex('{}', '{}')".format(layer.GetName(), geom_column))
+                if result is not None:
+                    dataset.ReleaseResultSet(result)
+        dataset = None
+    report_time(feedback, 'spatial indexes', start)
+
+    start = time.perf_counter()
+    con = lite.connect(geopackage)
+    try:
+        con.execute('ANALYZE')
+        con.execute('VACUUM')
+    finally:
+        con.close()
+    report_time(feedback, 'ANALYZE and VACUUM', start)
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+
+"""
+***************************************************************************
+*                                                                         *
+*   This program is free software; you can redistribute it and/or modify  *
+*   it under the terms of the GNU General Public License as published by  *
+*   the Free Software Foundation; either version 2 of the License, or     *
+*   (at your option) any later version.                                   *
+*                                                                         *
+***************************************************************************
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+
+from qgis.core import (QgsFeatureRequest,
+                       QgsGeometry,
+                       QgsSpatialIndex,
+                       QgsWkbTypes)
+
+
+class AvoidIntersectionsIndex:
+    '''Geometries of the layers to avoid intersections with, each layer read
+       once into a spatial index that stores its geometries.
+
+       QgsGeometry.avoidIntersections queries every layer for each geometry,
+       here the candidates are found in memory, and the index can be shared
+       by worker threads.'''
+
+    def __init__(self, layers, extent=None, feedback=None):
+        '''Read the features of layers, only inside extent if given.'''
+        self._indexes = []
+        for layer in layers:
+            request = QgsFeatureRequest().setNoAttributes()
+            if extent is not None and not extent.isEmpty():
+                request.setFilterRect(extent)
+            self._indexes.append(QgsSpatialIndex(layer.getFeatures(request), feedback,
+                                                 QgsSpatialIndex.FlagStoreFeatureGeometries))
+
+    def __len__(self):
+        return len(self._indexes)
+
+    def candidates(self, rect):
+        '''Geometries of the layers whose bounding box intersects rect.'''
+        return [index.geometry(fid) for index in self._indexes for fid in index.intersects(rect)]
+
+    def difference(self, geometry):
+        '''geometry without its intersections with the layers, as QgsGeometry.avoidIntersections.'''
+        candidates = self.candidates(geometry.boundingBox())
+        if not candidates:
+            return geometry
+        difference = geometry.difference(QgsGeometry.unaryUnion(candidates))
+        return geometry if difference.isNull() else difference
+
+
+class GeometryStage:
+    '''Geometries of source features in a target layer: converted to the
+       geometry type of the target, then cut by the layers to avoid
+       intersections with (polygon targets only), as QGIS does when pasting
+       features.
+
+       Geometries already of the target type aren't converted. With more than
+       one worker, the geometries of each chunk of features are split among a
+       pool of threads, GEOS running outside the GIL.'''
+
+    def __init__(self, target, avoid=None, workers=1):
+        self.spatial = target.isSpatial()
+        self.geometry_type = target.geometryType()
+        self.multi = QgsWkbTypes.isMultiType(target.wkbType())
+        self.avoid = avoid if avoid and self.geometry_type == QgsWkbTypes.PolygonGeometry else None
+        self.workers = workers
+        self._executor = ThreadPoolExecutor(max_workers=workers) if workers > 1 else None
+
+    def convert(self, geometry):
+        '''Geometry in the target, None if it can't be converted.'''
+        if geometry.isNull():
+            return geometry
+
+        if self.geometry_type != QgsWkbTypes.UnknownGeometry and (
+                geometry.type() != self.geometry_type or geometry.isMultipart() != self.multi):
+            geometry = geometry.convertToType(self.geometry_type, self.multi)
+            if geometry.isNull():
+                return None
+
+        if self.avoid:
+            geometry = self.avoid.difference(geometry)
+        return geometry
+
+    def _convert_all(self, geometries):
+        return [self.convert(geometry) for geometry in geometries]
+
+    def geometries(self, features):
+        '''Geometries of features in the target, in the same order, None for the ones that can't be converted.'''
+        geometries = [feature.geometry() if self.spatial and feature.hasGeometry() else QgsGeometry()
+                      for feature in features]
+        if self._executor is None or len(geometries) < 2:
+            return self._convert_all(geometries)
+
+        # One slice per worker, so a feature doesn't cost a task
+        size = -(-len(geometries) // self.workers)
+        slices = [geometries[i:i + size] for i in range(0, len(geometries), size)]
+        return [geometry for part in self._executor.map(self._convert_all, slices) for geometry in part]
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
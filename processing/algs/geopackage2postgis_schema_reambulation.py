@@ -11,6 +11,9 @@ from qgis.core import (QgsProcessingException,
                        QgsProcessingAlgorithm,
                        QgsVectorLayer,
                        QgsProcessingParameterFile,
+                       QgsProcessingParameterBoolean,
+                       QgsProcessingParameterNumber,
+                       QgsProcessingParameterEnum,
                        Qgis,
                        QgsProviderRegistry,
                        QgsDataSourceUri)
@@ -22,16 +25,28 @@ else:
     from qgis.core import QgsProcessingParameterProviderConnection
     from qgis.core import QgsProcessingParameterDatabaseSchema
 
-import sqlite3 as lite
+import time
 import processing
 import psycopg2
 
+from .bulk_loader import (LayerLoader, NO_ACTION, file_hash, format_counts, geopackage_layers,
+                          import_layers_concurrently, read_changelog)
+from .schema_introspection import split_patterns
+from .schema_introspection import SchemaCatalog
+
 class Geopackage2PostGISSchemaReambulation(QgsProcessingAlgorithm):
     # Constants used to refer to parameters    
     
     DATABASE = 'DATABASE'
     SCHEMA = 'SCHEMA'
     GEOPACKAGE = 'GEOPACKAGE'
+    BULK_COPY = 'BULK_COPY'
+    WORKERS = 'WORKERS'
+    ACTION_ON_DUPLICATE = 'ACTION_ON_DUPLICATE'
+    KEY_COLUMNS = 'KEY_COLUMNS'
+    RESUME = 'RESUME'
+    SUSPEND_INDEXES = 'SUSPEND_INDEXES'
+    CHANGES_ONLY = 'CHANGES_ONLY'
     #CLEAN_SCHEMA = 'CLEAN_SCHEMA'
 
     def tr(self, string):
@@ -94,6 +109,41 @@ class Geopackage2PostGISSchemaReambulation(QgsProcessingAlgorithm):
         # Geopackage
         self.addParameter(QgsProcessingParameterFile(self.GEOPACKAGE, 'Geopackage', 0, 'gpkg'))
         
+        # Bulk load with COPY instead of appending feature by feature
+        self.addParameter(QgsProcessingParameterBoolean(self.BULK_COPY,
+                                                        self.tr('Bulk load with COPY'),
+                                                        False, optional=True))
+        
+        # Layers loaded at the same time by the bulk load, one connection each
+        self.addParameter(QgsProcessingParameterNumber(self.WORKERS, self.tr('Parallel workers (bulk load)'),
+                                                       QgsProcessingParameterNumber.Integer, 1, False, 1))
+        
+        # Duplicates merged by the server on the key columns (bulk load)
+        self.addParameter(QgsProcessingParameterEnum(self.ACTION_ON_DUPLICATE,
+                                                     self.tr('Action for duplicate features (bulk load)'),
+                                                     [self.tr('Just APPEND all features, no matter of duplicates'),
+                                                      self.tr('If duplicate is found, SKIP feature'),
+                                                      self.tr('If duplicate is found, UPDATE existing feature')],
+                                                     False, NO_ACTION, optional=True))
+        self.addParameter(QgsProcessingParameterString(self.KEY_COLUMNS,
+                                                       self.tr('Key columns of the duplicates, comma separated (default: primary key)'),
+                                                       '', optional=True))
+        
+        # Layers recorded in the import journal of the schema are skipped (bulk load)
+        self.addParameter(QgsProcessingParameterBoolean(self.RESUME,
+                                                        self.tr('Resume: skip the layers already imported from this geopackage (bulk load)'),
+                                                        True, optional=True))
+        
+        # Indexes and triggers suspended during the load, indexes rebuilt and tables analyzed after it (bulk load)
+        self.addParameter(QgsProcessingParameterBoolean(self.SUSPEND_INDEXES,
+                                                        self.tr('Suspend indexes and triggers during the load (bulk load)'),
+                                                        False, optional=True))
+        
+        # Only the features of the change log written by the reambulation export, with a bulk load
+        self.addParameter(QgsProcessingParameterBoolean(self.CHANGES_ONLY,
+                                                        self.tr('Import only the edits of the change log (bulk load)'),
+                                                        False, optional=True))
+        
         # Clean Schema
         '''
         # If it is necessary to clean the schema
@@ -107,6 +157,33 @@ class Geopackage2PostGISSchemaReambulation(QgsProcessingAlgorithm):
     
 
 
+    def bulk_load(self, loader, layers_import, layers_info, layers_count, workers, feedback):
+        '''Load the layers with COPY, workers layers at a time.'''
+        if workers > 1:
+            # Largest layers first, so the import takes the time of the biggest one
+            layers_import = sorted(layers_import, key=lambda layer: layers_count[layer], reverse=True)
+            counts, errors = import_layers_concurrently(loader, layers_import, workers, (0, 100), layers_count)
+            if feedback.isCanceled():
+                return {'Result':'Canceled'}
+            if errors:
+                return {'Result':'Layers imported with errors', 'Failed layers':sorted(errors)}
+        else:
+            for current, layer in enumerate(layers_import):
+                feedback.pushInfo("Copying {}.{}".format(loader.schema, layer))
+                start = time.perf_counter()
+                progress = (100 * current // len(layers_import), 100 * (current + 1) // len(layers_import))
+                try:
+                    counts = loader.load(layer, progress, layers_info[layer].feature_count)
+                except (ValueError, psycopg2.Error) as e:
+                    raise QgsProcessingException('Layer {} not imported: {}'.format(layer, e))
+                if counts is None:
+                    return {'Result':'Canceled'}
+                feedback.pushInfo('Rows {} in {:.1f} s'.format(format_counts(counts), time.perf_counter() - start))
+                feedback.pushInfo('')
+
+        return {'Result':'Layers imported'}
+
+
     def processAlgorithm(self, parameters, context, feedback):
         
         # Dummy function to enable running an alg inside an alg
@@ -130,6 +207,13 @@ class Geopackage2PostGISSchemaReambulation(QgsProcessingAlgorithm):
             schema = self.parameterAsSchema(parameters, self.SCHEMA, context)
 
         geopackage = parameters[self.GEOPACKAGE]
+        bulk_copy = self.parameterAsBool(parameters, self.BULK_COPY, context)
+        workers = self.parameterAsInt(parameters, self.WORKERS, context)
+        action_on_duplicate = self.parameterAsEnum(parameters, self.ACTION_ON_DUPLICATE, context)
+        key_columns = split_patterns(self.parameterAsString(parameters, self.KEY_COLUMNS, context))
+        resume = self.parameterAsBool(parameters, self.RESUME, context)
+        suspend_indexes = self.parameterAsBool(parameters, self.SUSPEND_INDEXES, context)
+        changes_only = self.parameterAsBool(parameters, self.CHANGES_ONLY, context)
 
         
 
@@ -149,39 +233,34 @@ class Geopackage2PostGISSchemaReambulation(QgsProcessingAlgorithm):
         if not 'reamb' in schema:
             raise QgsProcessingException('A palavra reamb precisa fazer parte do nome do esquema')        
 
-        # Connect with Geopackage 
+        # Non-empty layers, with their metadata, from the geopackage catalog
         feedback.pushInfo('Listing non-empty layers from geopackage')
-        with lite.connect(geopackage) as con:
-            feedback.pushInfo('Con = ' + str(con))
-            
-            layers_import = [] # will store the non-empty tables
-            
-            # Create cursor
-            cur = con.cursor()
-            
-            # Fetch layer names
-            cur.execute("SELECT table_name FROM gpkg_geometry_columns")
-            rows = cur.fetchall()
-            layer_names = [camada[0] for camada in rows]
-            feedback.pushInfo('Layers = ' + str(layer_names)) 
-            
-
-            
-            # Append non-empty geometry layers to list 
-            for layer in layer_names:
-                # Count rows
-                cur.execute("SELECT COUNT(1) FROM {}".format(layer))
-                
-                rows = cur.fetchall()
-                rows_count = rows[0][0]                
-                #feedback.pushInfo('Rows = ' + str(rows_count))
-                
-                # Append to list
-                if rows_count > 0:
-                    #feedback.pushInfo('Table non-empty = ' + str(rows_count))
-                    layers_import.append(layer)
+        layers_info = {layer.name: layer for layer in geopackage_layers(geopackage)}
+        layers_import = list(layers_info) # will store the non-empty tables
+        # Unknown counts (layers found by the EXISTS probe) weigh as a single feature
+        layers_count = {layer.name: layer.feature_count or 1 for layer in layers_info.values()}
+        
+        # Change log mode: the edited layers, even if all their features were deleted
+        changes = None
+        if changes_only:
+            changes = read_changelog(geopackage)
+            if changes is None:
+                raise QgsProcessingException('The geopackage has no change log')
+            layers_info = {layer.name: layer for layer in geopackage_layers(geopackage, False) if layer.name in changes}
+            layers_import = list(layers_info)
+            layers_count = {layer: max(changes[layer].inserted + changes[layer].updated + len(changes[layer].deleted)
+                                       + len(changes[layer].discarded), 1) for layer in layers_import}
+            bulk_copy = True
+            for layer in layers_import:
+                feedback.pushInfo('{}: {} features inserted, {} updated, {} deleted, {} inserted then deleted'.format(
+                    layer, changes[layer].inserted, changes[layer].updated, len(changes[layer].deleted),
+                    len(changes[layer].discarded)))
         
                     
+        for layer in layers_info.values():
+            feedback.pushInfo('{}: {} features, {} ({}), SRS {}, extent {}'.format(
+                layer.name, 'unknown' if layer.feature_count is None else layer.feature_count,
+                layer.geometry_type, layer.geometry_column, layer.srs_id, layer.extent))
         feedback.pushInfo('Non-empty tables = ' + str(layers_import))
         feedback.pushInfo('')
 
@@ -216,8 +295,8 @@ class Geopackage2PostGISSchemaReambulation(QgsProcessingAlgorithm):
                     feedback.pushInfo("Deleting from {}.{}".format(schema, table))
                     cur.execute("DELETE FROM {}.{}".format(schema, table))
                     con.commit()
+                cur.close()
                         
-        cur.close()
         con.close()
          
         feedback.pushInfo('')
@@ -249,6 +328,54 @@ class Geopackage2PostGISSchemaReambulation(QgsProcessingAlgorithm):
         
         
         
+        # Bulk import: stream each layer with COPY, one transaction per layer
+        if bulk_copy:
+            catalog = SchemaCatalog(uri, schema)
+            missing = [layer for layer in layers_import if catalog.table(layer) is None]
+            if missing:
+                raise QgsProcessingException('Target layer not valid: ' + ', '.join(missing))
+
+            # Every layer loaded is journaled with the hash of the geopackage, in the transaction of its load
+            start = time.perf_counter()
+            journal = file_hash(geopackage)
+            feedback.pushInfo('Geopackage hash = {} ({:.1f} s)'.format(journal, time.perf_counter() - start))
+
+            loader = LayerLoader(uri, schema, catalog, geopackage, feedback, workers, action_on_duplicate, key_columns,
+                                 journal, changes)
+            try:
+                # Indexes and triggers left suspended by an interrupted load
+                if loader.restore(workers):
+                    raise QgsProcessingException('Indexes or triggers of a previous bulk load could not be restored')
+
+                completed = loader.completed_layers()
+                if resume and completed:
+                    skipped = [layer for layer in layers_import if layer in completed]
+                    feedback.pushInfo('Already imported, skipped = ' + str(skipped))
+                    layers_import = [layer for layer in layers_import if layer not in completed]
+                    feedback.pushInfo('')
+
+                if suspend_indexes and layers_import:
+                    feedback.pushInfo('Suspended indexes and triggers = ' + str(loader.suspend(layers_import)))
+                restore_errors = dict()
+                try:
+                    result = self.bulk_load(loader, layers_import, layers_info, layers_count, workers, feedback)
+                finally:
+                    if suspend_indexes and layers_import:
+                        start = time.perf_counter()
+                        restore_errors = loader.restore(workers)
+                        feedback.pushInfo('Time of the index rebuild: {:.1f} s'.format(time.perf_counter() - start))
+                        for name, error in sorted(restore_errors.items()):
+                            feedback.reportError('{} not restored: {}'.format(name, error))
+                        loader.analyze(layers_import)
+            finally:
+                loader.close()
+
+            # The objects not restored stay recorded, and are restored by the next bulk load
+            if restore_errors:
+                result['Result'] += ', indexes not restored'
+                result['Failed objects'] = sorted(restore_errors)
+            return result
+
         # Import layers
         for layer in layers_import:
             feedback.pushInfo("Importing {}.{}".format(schema, layer))
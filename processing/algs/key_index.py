@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+
+"""
+***************************************************************************
+*                                                                         *
+*   This program is free software; you can redistribute it and/or modify  *
+*   it under the terms of the GNU General Public License as published by  *
+*   the Free Software Foundation; either version 2 of the License, or     *
+*   (at your option) any later version.                                   *
+*                                                                         *
+***************************************************************************
+"""
+
+import heapq
+import sys
+from array import array
+from bisect import bisect_left
+
+from qgis.PyQt.QtCore import QVariant
+from qgis.core import NULL
+
+
+# Field types whose values are keyed as int, float (int when integral) and str
+FIELD_KINDS = dict([(field_type, 'integer') for field_type in (QVariant.Int, QVariant.UInt, QVariant.LongLong, QVariant.ULongLong)] +
+                   [(QVariant.Double, 'real'), (QVariant.String, 'text')])
+
+
+
+def _integer(value):
+    return int(value)
+
+
+def _real(value):
+    # 5.0 and 5 are the same key
+    value = float(value)
+    return int(value) if value.is_integer() else value
+
+
+def _integral_real(value):
+    value = float(value)
+    return int(value) if value.is_integer() else None
+
+
+def _integer_text(value):
+    return int(value.strip())
+
+
+def _real_text(value):
+    return _real(value.strip())
+
+
+def _text(value):
+    return str(value)
+
+
+def _real_as_text(value):
+    value = float(value)
+    return str(int(value)) if value.is_integer() else repr(value)
+
+
+# Integer field types whose keys always fit in an int64 array
+INT64_TYPES = (QVariant.Int, QVariant.UInt, QVariant.LongLong)
+
+# Conversion of a value of a field kind (first) to a key of another field kind (second)
+CONVERTERS = {('integer', 'integer'): _integer, ('real', 'integer'): _integral_real, ('text', 'integer'): _integer_text,
+              ('integer', 'real'): _real, ('real', 'real'): _real, ('text', 'real'): _real_text,
+              ('integer', 'text'): _text, ('real', 'text'): _real_as_text, ('text', 'text'): _text}
+
+
+
+def key_normalizer(field_type):
+    '''Function value -> key of the values of a field type, so the keys of the target index are canonical.'''
+    kind = FIELD_KINDS.get(field_type)
+    return CONVERTERS[(kind, kind)] if kind else (lambda value: value)
+
+
+def key_converter(source_type, target_type):
+    '''Function source value -> key of the target index, None if the value can't be a target value.
+
+       The function is resolved once for the pair of field types, so the
+       lookup of each source value is a single call and a dict probe. NULL is
+       never a key. Pairs of other field types fall back to QVariant.'''
+    if source_type == target_type:
+        convert = key_normalizer(target_type)
+    else:
+        convert = CONVERTERS.get((FIELD_KINDS.get(source_type), FIELD_KINDS.get(target_type)))
+
+    if convert is None:
+        normalize = key_normalizer(target_type)
+
+        def convert(value):
+            qvariant_value = QVariant(value)
+            if qvariant_value.canConvert(target_type) and qvariant_value.convert(target_type):
+                return normalize(qvariant_value.value())
+            return None
+
+    def converter(value):
+        if value is None or value == NULL:
+            return None
+        try:
+            return convert(value)
+        except (TypeError, ValueError):
+            return None
+
+    return converter
+
+
+def key_array(field_type):
+    '''Empty container for the keys of a field type, an int64 array for integer fields.'''
+    return array('q') if field_type in INT64_TYPES else []
+
+
+def _like(sequence, values):
+    '''values in a sequence of the type of sequence, an array or a list.'''
+    return array(sequence.typecode, values) if isinstance(sequence, array) else list(values)
+
+
+class KeyIndex:
+    '''Compact index {key: target feature ids} of the values of a target field.
+
+       The distinct keys are kept sorted, in an int64 array when they are
+       integers, with the offsets of their ids in a single int64 array of
+       feature ids. A target costs a few bytes per feature instead of a dict
+       entry, a list and boxed ints per key. Keys are probed by binary search.'''
+
+    # Features sorted at a time while the index is built
+    BLOCK_SIZE = 1 << 16
+
+    def __init__(self, keys, ids):
+        '''keys and ids are parallel sequences, in any order, of the keys and the ids of the target features.
+
+           They are sorted in place by blocks of BLOCK_SIZE, then the sorted
+           blocks are merged into the index, so that only one block of keys and
+           ids is held as Python objects at a time.'''
+        count = len(keys)
+        blocks = [(start, min(start + self.BLOCK_SIZE, count)) for start in range(0, count, self.BLOCK_SIZE)]
+        for start, end in blocks:
+            block = sorted(zip(keys[start:end], ids[start:end]))
+            keys[start:end] = _like(keys, (key for key, fid in block))
+            ids[start:end] = _like(ids, (fid for key, fid in block))
+        merged = heapq.merge(*(((keys[i], ids[i]) for i in range(start, end)) for start, end in blocks))
+
+        self._ids = array('q')
+        self._offsets = array('q')
+        unique = [] if isinstance(keys, list) else array('q')
+        for position, (key, fid) in enumerate(merged):
+            if not unique or key != unique[-1]:
+                unique.append(key)
+                self._offsets.append(position)
+            self._ids.append(fid)
+        self._offsets.append(count)
+        self._keys = unique
+
+    def __len__(self):
+        return len(self._ids)
+
+    def key_count(self):
+        '''Number of distinct keys.'''
+        return len(self._keys)
+
+    def nbytes(self):
+        '''Approximate memory used by the index, in bytes.'''
+        if isinstance(self._keys, array):
+            keys = self._keys.itemsize * len(self._keys)
+        else:
+            keys = sys.getsizeof(self._keys) + sum(sys.getsizeof(key) for key in self._keys)
+        return keys + self._offsets.itemsize * len(self._offsets) + self._ids.itemsize * len(self._ids)
+
+    def _position(self, key, lo=0):
+        try:
+            i = bisect_left(self._keys, key, lo)
+        except TypeError:
+            return None
+        if i < len(self._keys) and self._keys[i] == key:
+            return i
+        return None
+
+    def get(self, key):
+        '''Ids (int64 array) of the target features with the key, None if there are none.'''
+        if key is None:
+            return None
+        i = self._position(key)
+        return None if i is None else self._ids[self._offsets[i]:self._offsets[i + 1]]
+
+    def lookup(self, keys):
+        '''{key: ids} of the keys found among keys, for example the keys of a chunk of source features.
+
+           The keys are looked up at once in sorted order, each search starting
+           where the previous one ended.'''
+        found = dict()
+        keys = set(key for key in keys if key is not None)
+        try:
+            keys = sorted(keys)
+        except TypeError:
+            # Keys that can't be ordered together are looked up one by one
+            return {key: ids for key, ids in ((key, self.get(key)) for key in keys) if ids is not None}
+
+        lo = 0
+        for key in keys:
+            try:
+                i = bisect_left(self._keys, key, lo)
+            except TypeError:
+                continue
+            if i == len(self._keys):
+                break
+            if self._keys[i] == key:
+                found[key] = self._ids[self._offsets[i]:self._offsets[i + 1]]
+            lo = i
+        return found
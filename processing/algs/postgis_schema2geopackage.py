@@ -18,6 +18,8 @@ from qgis.core import (QgsVectorLayer,
                        QgsProcessingParameterString,
                        QgsProcessingParameterFile,
                        QgsProcessingParameterFileDestination,
+                       QgsProcessingParameterNumber,
+                       QgsProcessingParameterBoolean,
                        Qgis,
                        QgsProviderRegistry,
                        QgsDataSourceUri)
@@ -29,7 +31,23 @@ else:
     from qgis.core import QgsProcessingParameterProviderConnection
     from qgis.core import QgsProcessingParameterDatabaseSchema
 
-import subprocess 
+from .export_engine import (ExportEngine,
+                            add_table_selection_parameters,
+                            begin_incremental_export,
+                            dataset_signature,
+                            export_options,
+                            selected_tables,
+                            server_clip_queries,
+                            export_schema_parallel,
+                            write_manifest,
+                            finish_fast_write,
+                            report_time,
+                            FAST_WRITE_OPTIONS,
+                            FAST_WRITE_CONFIG,
+                            TABLE_SELECTION_HELP)
+from .schema_introspection import SchemaCatalog
+
+import time
 
 class PostGISSchema2Geopackage(QgsProcessingAlgorithm):
     # Constants used to refer to parameters 
@@ -38,6 +56,13 @@ class PostGISSchema2Geopackage(QgsProcessingAlgorithm):
     SCHEMA = 'SCHEMA'
     SHAPEFILE = 'SHAPEFILE'
     GEOPACKAGE = 'GEOPACKAGE'
+    WORKERS = 'WORKERS'
+    INCREMENTAL = 'INCREMENTAL'
+    CLIP_ON_SERVER = 'CLIP_ON_SERVER'
+    FAST_WRITE = 'FAST_WRITE'
+    INCLUDE_TABLES = 'INCLUDE_TABLES'
+    EXCLUDE_TABLES = 'EXCLUDE_TABLES'
+    SKIP_EMPTY = 'SKIP_EMPTY'
 
     def tr(self, string):
         """
@@ -61,7 +86,17 @@ class PostGISSchema2Geopackage(QgsProcessingAlgorithm):
         return 'export'
 
     def shortHelpString(self):
-        return self.tr("Export the layers in a PostGIS schema to a geopackage.")
+        return self.tr("Export the layers in a PostGIS schema to a geopackage.\n\n"
+                       "With more than one parallel worker, each table is extracted by its own worker "
+                       "into a temporary geopackage, largest tables first, and the temporary "
+                       "geopackages are merged into the final geopackage at the end.\n\n"
+                       "In incremental mode a manifest with a fingerprint of each table is stored in "
+                       "the geopackage, and later runs only export the tables whose fingerprint changed.\n\n"
+                       "When clipping on the database server, each table is read with a query that only "
+                       "returns the features intersecting the clip shapefile, already clipped by PostGIS.\n\n"
+                       "The fast write profile writes the geopackage in big transactions without SQLite journal "
+                       "and synchronization, creates the spatial indexes after the data and ends with ANALYZE "
+                       "and VACUUM. The time of each phase is reported.\n\n" + TABLE_SELECTION_HELP)
 
     def initAlgorithm(self, config=None):
         # Database Connection
@@ -103,6 +138,25 @@ class PostGISSchema2Geopackage(QgsProcessingAlgorithm):
         
         # Geopackage
         self.addParameter(QgsProcessingParameterFileDestination(self.GEOPACKAGE, 'Geopackage', '*.gpkg'))
+
+        # Table selection
+        add_table_selection_parameters(self)
+
+        # Clip with PostGIS instead of ogr2ogr
+        self.addParameter(QgsProcessingParameterBoolean(self.CLIP_ON_SERVER, self.tr('Clip on the database server (PostGIS)'),
+                                                        False, optional=True))
+
+        # Number of tables extracted at the same time
+        self.addParameter(QgsProcessingParameterNumber(self.WORKERS, self.tr('Parallel workers'),
+                                                       QgsProcessingParameterNumber.Integer, 1, False, 1))
+
+        # Fast write profile
+        self.addParameter(QgsProcessingParameterBoolean(self.FAST_WRITE, self.tr('Fast write profile'),
+                                                        False, optional=True))
+
+        # Only export the tables changed since the last export to the geopackage
+        self.addParameter(QgsProcessingParameterBoolean(self.INCREMENTAL, self.tr('Incremental export (only changed tables)'),
+                                                        False, optional=True))
        
     def processAlgorithm(self, parameters, context, feedback):
         # Retrieving parameters
@@ -122,6 +176,10 @@ class PostGISSchema2Geopackage(QgsProcessingAlgorithm):
 
         shape = self.parameterAsFile(parameters, self.SHAPEFILE, context)
         geopackage = parameters[self.GEOPACKAGE]
+        workers = self.parameterAsInt(parameters, self.WORKERS, context)
+        incremental = self.parameterAsBool(parameters, self.INCREMENTAL, context)
+        clip_on_server = self.parameterAsBool(parameters, self.CLIP_ON_SERVER, context)
+        fast_write = self.parameterAsBool(parameters, self.FAST_WRITE, context)
         
         # Execute ogr2ogr only in case the shape is Valid or no shape was provided
         shape_qgs = QgsVectorLayer(shape, 'test_valid', 'ogr')
@@ -132,20 +190,69 @@ class PostGISSchema2Geopackage(QgsProcessingAlgorithm):
         else:
             raise QgsProcessingException("Invalid shape")
 
-        # Text for ogr2ogr
-        if shape == '':
-            target_ogr = "ogr2ogr -f GPKG {} -overwrite {} ".format(geopackage, shape)
+        # Schema tables, read once for the whole run
+        catalog = SchemaCatalog(uri, schema)
+
+        # Selected tables, largest first, given explicitly to every export mode
+        tables = selected_tables(self, parameters, context, catalog, feedback)
+        if not tables:
+            return {'Result': 'Exported'}
+
+        # The content of the clip shapefile, not only its path, tells if the clipped tables changed
+        fingerprint_options = ' clip ' + dataset_signature(shape) if incremental and shape != '' else ''
+
+        # Clip on the server: one query per table, keeping the primary keys as FID
+        queries = None
+        if clip_on_server and shape != '':
+            feedback.pushInfo('Clipping on the database server')
+            queries = server_clip_queries(catalog, shape_qgs, keep_fid=True)
+            fingerprint_options += ' server clip ' + shape
+            shape = ''
+
+        # Options for ogr2ogr
+        options = export_options('GPKG', clip=shape)
+
+        # Incremental mode: only the tables whose fingerprint changed
+        if incremental:
+            changed, removed, tables = begin_incremental_export(catalog, geopackage, tables, feedback,
+                                                                ' '.join(options) + fingerprint_options)
+            if not changed:
+                return {'Result': 'Exported'}
+
+        # Fast write profile, which doesn't change the content of the geopackage
+        config = None
+        merge_options = ['-overwrite']
+        if fast_write:
+            options += FAST_WRITE_OPTIONS
+            merge_options += FAST_WRITE_OPTIONS
+            config = FAST_WRITE_CONFIG
+
+        feedback.pushInfo('Options for ogr2ogr = ' + ' '.join(options))
+        start = time.perf_counter()
+
+        if workers > 1:
+            # Parallel mode: one worker per table, then merge
+            feedback.pushInfo('Exporting with {} parallel workers'.format(workers))
+            export_schema_parallel(catalog, geopackage, workers, feedback, options, tables, queries,
+                                   merge_options, config)
+            exported = not feedback.isCanceled()
         else:
-            target_ogr = "ogr2ogr -f GPKG {} -overwrite -clipsrc {} ".format(geopackage, shape)    
-            
-        source_ogr = 'PG:"host={} dbname={} schemas={} port={} user={} password={}" '.format(uri.host(), uri.database(), schema, uri.port(), uri.username(), uri.password())
-        string_ogr = target_ogr + source_ogr
-        feedback.pushInfo('Text for ogr2ogr = ' + string_ogr)
-
-        # Export schema to geopackage
-        try:
-            process = subprocess.run(string_ogr, shell=True, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        except subprocess.CalledProcessError as e:
-            raise QgsProcessingException(str(e.stderr.decode('utf-8')))
+            # Export schema to geopackage
+            engine = ExportEngine(uri, schema, feedback, queries, config)
+            try:
+                exported = engine.export(geopackage, options, tables)
+            finally:
+                engine.close()
+
+        if not exported:
+            return {'Result': 'Canceled'}
+
+        report_time(feedback, 'export', start)
+
+        if incremental:
+            write_manifest(geopackage, changed, removed)
+
+        if fast_write:
+            finish_fast_write(geopackage, feedback)
 
         return {'Result': 'Exported'}
\ No newline at end of file
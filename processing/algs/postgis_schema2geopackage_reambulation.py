@@ -19,6 +19,7 @@ from qgis.core import (QgsVectorLayer,
                        QgsProcessingParameterString,
                        QgsProcessingParameterFile,
                        QgsProcessingParameterFileDestination,
+                       QgsProcessingParameterBoolean,
                        Qgis,
                        QgsProviderRegistry,
                        QgsDataSourceUri)
@@ -32,9 +33,22 @@ else:
 
     
 import sqlite3 as lite
-import psycopg2
-import subprocess 
-from PyQt5.QtCore import QVariant
+
+from .export_engine import (ExportEngine,
+                            add_table_selection_parameters,
+                            begin_incremental_export,
+                            export_options,
+                            selected_tables,
+                            write_manifest,
+                            finish_fast_write,
+                            install_changelog,
+                            report_time,
+                            FAST_WRITE_OPTIONS,
+                            FAST_WRITE_CONFIG,
+                            TABLE_SELECTION_HELP)
+from .schema_introspection import SchemaCatalog
+
+import time
 
 
 class PostGISSchema2GeopackageReambulation(QgsProcessingAlgorithm):
@@ -44,6 +58,12 @@ class PostGISSchema2GeopackageReambulation(QgsProcessingAlgorithm):
     SCHEMA = 'SCHEMA'
     SHAPEFILE = 'SHAPEFILE'
     GEOPACKAGE = 'GEOPACKAGE'
+    INCREMENTAL = 'INCREMENTAL'
+    FAST_WRITE = 'FAST_WRITE'
+    CHANGE_LOG = 'CHANGE_LOG'
+    INCLUDE_TABLES = 'INCLUDE_TABLES'
+    EXCLUDE_TABLES = 'EXCLUDE_TABLES'
+    SKIP_EMPTY = 'SKIP_EMPTY'
 
     def tr(self, string):
         """
@@ -67,7 +87,12 @@ class PostGISSchema2GeopackageReambulation(QgsProcessingAlgorithm):
         return 'reambulation'
 
     def shortHelpString(self):
-        return self.tr("Export the layers in a PostGIS schema to a geopackage in order to do reambulation.")
+        return self.tr("Export the layers in a PostGIS schema to a geopackage in order to do reambulation.\n\n"
+                       "In incremental mode a manifest with a fingerprint of each table is stored in "
+                       "the geopackage, and later runs only export the tables whose fingerprint changed.\n\n"
+                       "The fast write profile writes the geopackage in big transactions without SQLite journal "
+                       "and synchronization, creates the spatial indexes after the data and ends with ANALYZE "
+                       "and VACUUM. The time of each phase is reported.\n\n" + TABLE_SELECTION_HELP)
 
     def initAlgorithm(self, config=None):
         # Database Connection
@@ -109,6 +134,21 @@ class PostGISSchema2GeopackageReambulation(QgsProcessingAlgorithm):
         
         # Geopackage
         self.addParameter(QgsProcessingParameterFileDestination(self.GEOPACKAGE, 'Geopackage', '*.gpkg'))
+
+        # Table selection
+        add_table_selection_parameters(self)
+
+        # Fast write profile
+        self.addParameter(QgsProcessingParameterBoolean(self.FAST_WRITE, self.tr('Fast write profile'),
+                                                        False, optional=True))
+
+        # Only export the tables changed since the last export to the geopackage
+        self.addParameter(QgsProcessingParameterBoolean(self.INCREMENTAL, self.tr('Incremental export (only changed tables)'),
+                                                        False, optional=True))
+
+        # Log the field edits, so the import can apply only the changed features
+        self.addParameter(QgsProcessingParameterBoolean(self.CHANGE_LOG, self.tr('Track the edits in a change log'),
+                                                        False, optional=True))
         
     def processAlgorithm(self, parameters, context, feedback):
         # Retrieving parameters
@@ -128,6 +168,9 @@ class PostGISSchema2GeopackageReambulation(QgsProcessingAlgorithm):
 
         shape = self.parameterAsFile(parameters, self.SHAPEFILE, context)
         geopackage = parameters[self.GEOPACKAGE]
+        incremental = self.parameterAsBool(parameters, self.INCREMENTAL, context)
+        fast_write = self.parameterAsBool(parameters, self.FAST_WRITE, context)
+        change_log = self.parameterAsBool(parameters, self.CHANGE_LOG, context)
 
         # Execute ogr2ogr only in case the shape is Valid or no shape was provided
         shape_qgs = QgsVectorLayer(shape, 'test_valid', 'ogr')
@@ -138,118 +181,91 @@ class PostGISSchema2GeopackageReambulation(QgsProcessingAlgorithm):
         else:
             raise QgsProcessingException("Invalid shape")
 
-        # Text for ogr2ogr
+        # Options for ogr2ogr
         extension = shape_qgs.extent()
         if shape == '':
-            target_ogr = "ogr2ogr -f GPKG {} -overwrite -forceNullable {} ".format(geopackage, shape)
+            options = export_options('GPKG', extra=['-forceNullable'])
         else:
-            target_ogr = "ogr2ogr -f GPKG {} -overwrite -forceNullable -spat {} {} {} {} ".format(geopackage, str(extension.xMinimum()), str(extension.yMinimum()), str(extension.xMaximum()), str(extension.yMaximum()))    
+            options = export_options('GPKG', extra=['-forceNullable', '-spat', str(extension.xMinimum()), str(extension.yMinimum()),
+                                                    str(extension.xMaximum()), str(extension.yMaximum())])
+
+        # Schema tables, read once for the whole run
+        catalog = SchemaCatalog(uri, schema)
+
+        # Selected tables, largest first, given explicitly to every export mode
+        tables = selected_tables(self, parameters, context, catalog, feedback)
+        if not tables:
+            return {'Result': 'Exported'}
+
+        # Incremental mode: only the tables whose fingerprint changed
+        if incremental:
+            changed, removed, tables = begin_incremental_export(catalog, geopackage, tables, feedback,
+                                                                ' '.join(options))
+            if not changed:
+                return {'Result': 'Exported'}
+
+        # Fast write profile, which doesn't change the content of the geopackage
+        config = None
+        if fast_write:
+            options += FAST_WRITE_OPTIONS
+            config = FAST_WRITE_CONFIG
             
-        source_ogr = 'PG:"host={} dbname={} schemas={} port={} user={} password={}" '.format(uri.host(), uri.database(), schema, uri.port(), uri.username(), uri.password())
-        string_ogr = target_ogr + source_ogr
-        feedback.pushInfo('Text for ogr2ogr = ' + string_ogr)
+        feedback.pushInfo('Options for ogr2ogr = ' + ' '.join(options))
+        start = time.perf_counter()
 
         # Export schema to geopackage
+        engine = ExportEngine(uri, schema, feedback, config=config)
         try:
-            processo = subprocess.run(string_ogr, shell=True, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, stdin=subprocess.DEVNULL)
-        except subprocess.CalledProcessError as e:
-            raise QgsProcessingException(str(e.stderr.decode('utf-8')))
+            exported = engine.export(geopackage, options, tables)
+        finally:
+            engine.close()
 
+        if not exported:
+            return {'Result': 'Canceled'}
 
+        report_time(feedback, 'export', start)
 
-        # Connect with PostGIS database
-        con = psycopg2.connect(user = uri.username(), password = uri.password(), 
-                                       host = uri.host(), port = uri.port(), database = uri.database())
 
-        feedback.pushInfo('Uri = ' + str(uri))
-        feedback.pushInfo('Uri text = ' + uri.uri())         
-        feedback.pushInfo('Connection = ' + str(con))
-        feedback.pushInfo('')
+        # Columns with array type of each table, from the schema catalog
+        dict_table_arrcolumns = dict()
+        # Tables kept from a previous incremental export already have their arrays converted
+        for table in map(catalog.table, tables):
+            if table.array_columns:
+                dict_table_arrcolumns[table.name] = table.array_columns
 
-        # Query columns with array type
-        with con:
-            select_schema_tables = "SELECT table_name FROM information_schema.tables " \
-                                   "WHERE table_type = '{}' AND table_schema = '{}'".format('BASE TABLE', schema)
-            
-            feedback.pushInfo('consulta = ' + select_schema_tables)
-
-                                    
-            cur = con.cursor()
-             
-            cur.execute(select_schema_tables)
-             
-            rows = cur.fetchall()
- 
-            schema_tables = [table[0] for table in rows]
-            feedback.pushInfo('schema tables = ' + str(schema_tables))
-            feedback.pushInfo('')
-            
-            dict_table_arrcolumns = dict()
-            
-            feedback.pushInfo('Loop para gerar dicionário. Uma lista contendo nome das colunas ARRAY para cada tabela')
-            for table in schema_tables:
-                select_columns = "SELECT column_name FROM information_schema.columns " \
-                                 "WHERE data_type = 'ARRAY' AND table_schema = '{}' AND table_name = '{}'".format(schema, table)
-                
-                feedback.pushInfo('consulta para tabela ' + table + ': ' + select_columns)
-                        
-                
-                cur.execute(select_columns)
-                
-                rows = cur.fetchall()
-                
-                table_arrcolumns = [table[0] for table in rows]
-
-                if table_arrcolumns != []:
-                    dict_table_arrcolumns[table] = table_arrcolumns
-                
-            feedback.pushInfo('dicionario tabelas - colunas tipo array = ' + str(dict_table_arrcolumns))
-            feedback.pushInfo('')
-                        
-        cur.close()
-        con.close()
-
-
-# =============================================================================
-#         # Connect with Geopackage to UPDATE columns of array type 
-#         feedback.pushInfo('Connecting to Geopackage to update array columns')
-#         with lite.connect(geopackage) as con:
-#             feedback.pushInfo('Con = ' + str(con))
-#             
-#             # Create cursor
-#             cur = con.cursor()
-#             
-#             # Loop in dictionary of table:array columns
-#             for table, arrcolumn in dict_table_arrcolumns.items():
-#                 for column in arrcolumn:
-#                     # Select query = """SELECT tipoproduto, '{' || substr(replace(tipoproduto, ')', '}'), 4) FROM {}""".format(table)
-#                     update_query = """UPDATE {} SET {} = '{{' || substr(replace({}, ')', '}}'), 4)""".format(table, column, column)
-#                     feedback.pushInfo('Update query = ' + update_query)
-#                     cur.execute(update_query)
-#                     con.commit()
-# =============================================================================
-                    
-                    
-        # UPDATE columns of array type inside Geopackage using PyQGIS
-        for table, arrcolumn in dict_table_arrcolumns.items():
-            uri_geopackage = geopackage + '|layername=' + table
-            source = QgsVectorLayer(uri_geopackage, 'geopackage_layer', 'ogr')
-            if not source.isValid():
-                raise QgsProcessingException('Source layer not valid') 
-            
-            features = source.getFeatures()
-
-            for f in features:
-                fid = f.id()
-                for column in arrcolumn:
-                    fvalue = f[column]
-                    if isinstance(fvalue, QVariant):
-                        continue
-                    mfvalue = '{' + fvalue.replace(')', '}')[3:]
-                    findex = source.fields().indexFromName(column)
-                    attr = {findex:mfvalue}
-                    source.dataProvider().changeAttributeValues({ fid : attr })
+        feedback.pushInfo('dicionario tabelas - colunas tipo array = ' + str(dict_table_arrcolumns))
+        feedback.pushInfo('')
 
+        # UPDATE columns of array type inside Geopackage, one set-based statement per column.
+        # ogr2ogr writes the arrays as '(n:a,b,c)', which becomes the PostgreSQL literal '{a,b,c}'
+        feedback.pushInfo('Connecting to Geopackage to update array columns')
+        start = time.perf_counter()
+        con = lite.connect(geopackage)
+        try:
+            with con:
+                cur = con.cursor()
+                for table, arrcolumn in dict_table_arrcolumns.items():
+                    for column in arrcolumn:
+                        update_query = ('''UPDATE "{0}" SET "{1}" = '{{' || substr("{1}", instr("{1}", ':') + 1, '''
+                                        '''length("{1}") - instr("{1}", ':') - 1) || '}}' WHERE "{1}" LIKE '(%:%)' ''').format(table, column)
+                        feedback.pushInfo('Update query = ' + update_query)
+                        cur.execute(update_query)
+                cur.close()
+        finally:
+            con.close()
+
+        report_time(feedback, 'array columns conversion', start)
+
+        if incremental:
+            write_manifest(geopackage, changed, removed)
+
+        # Triggers logging the field edits, installed after the array conversion so it isn't logged
+        if change_log:
+            logged = install_changelog(geopackage, tables)
+            feedback.pushInfo('Layers with change log = {}'.format(len(logged)))
+
+        if fast_write:
+            finish_fast_write(geopackage, feedback)
     
         return {'Result': 'Exported'}
     
@@ -17,6 +17,8 @@ from qgis.core import (QgsVectorLayer,
                        QgsProcessingAlgorithm,
                        QgsProcessingParameterString,
                        QgsProcessingParameterFile,
+                       QgsProcessingParameterBoolean,
+                       QgsProcessingParameterNumber,
                        Qgis,
                        QgsProviderRegistry,
                        QgsDataSourceUri)
@@ -28,7 +30,16 @@ else:
     from qgis.core import QgsProcessingParameterProviderConnection
     from qgis.core import QgsProcessingParameterDatabaseSchema
 
-import subprocess 
+from .export_engine import (ExportEngine,
+                            add_table_selection_parameters,
+                            export_options,
+                            selected_tables,
+                            server_clip_queries,
+                            export_tables_concurrently,
+                            TABLE_SELECTION_HELP)
+from .schema_introspection import SchemaCatalog
+
+import os
 
 class PostGISSchema2Shapefile(QgsProcessingAlgorithm):
     # Constants used to refer to parameters 
@@ -37,6 +48,11 @@ class PostGISSchema2Shapefile(QgsProcessingAlgorithm):
     SCHEMA = 'SCHEMA'
     SHAPEFILE_CLIP = 'SHAPEFILE_CLIP'
     SHAPEFILE_FOLDER = 'SHAPEFILE_FOLDER'
+    CLIP_ON_SERVER = 'CLIP_ON_SERVER'
+    WORKERS = 'WORKERS'
+    INCLUDE_TABLES = 'INCLUDE_TABLES'
+    EXCLUDE_TABLES = 'EXCLUDE_TABLES'
+    SKIP_EMPTY = 'SKIP_EMPTY'
 
 
     def tr(self, string):
@@ -61,7 +77,12 @@ class PostGISSchema2Shapefile(QgsProcessingAlgorithm):
         return 'export'
 
     def shortHelpString(self):
-        return self.tr("Export the layers in a PostGIS schema to a folder of shapefiles.")
+        return self.tr("Export the layers in a PostGIS schema to a folder of shapefiles.\n\n"
+                       "When clipping on the database server, each table is read with a query that only "
+                       "returns the features intersecting the clip shapefile, already clipped by PostGIS.\n\n"
+                       "With more than one parallel worker, the tables are exported to their shapefiles "
+                       "at the same time, largest tables first. A table that fails is reported and "
+                       "doesn't stop the export of the other tables.\n\n" + TABLE_SELECTION_HELP)
 
     def initAlgorithm(self, config=None):
         # Database Connection
@@ -103,6 +124,17 @@ class PostGISSchema2Shapefile(QgsProcessingAlgorithm):
         
         # Shapefile folder
         self.addParameter(QgsProcessingParameterFile(self.SHAPEFILE_FOLDER, self.tr('Shapefile Folder'), 1, 'shp', optional=False))
+
+        # Clip with PostGIS instead of ogr2ogr
+        self.addParameter(QgsProcessingParameterBoolean(self.CLIP_ON_SERVER, self.tr('Clip on the database server (PostGIS)'),
+                                                        False, optional=True))
+
+        # Table selection
+        add_table_selection_parameters(self)
+
+        # Number of tables exported at the same time
+        self.addParameter(QgsProcessingParameterNumber(self.WORKERS, self.tr('Parallel workers'),
+                                                       QgsProcessingParameterNumber.Integer, 1, False, 1))
         
     def processAlgorithm(self, parameters, context, feedback):
         # Retrieving parameters
@@ -122,6 +154,8 @@ class PostGISSchema2Shapefile(QgsProcessingAlgorithm):
 
         shapec = self.parameterAsFile(parameters, self.SHAPEFILE_CLIP, context)
         shapef = parameters[self.SHAPEFILE_FOLDER]
+        clip_on_server = self.parameterAsBool(parameters, self.CLIP_ON_SERVER, context)
+        workers = self.parameterAsInt(parameters, self.WORKERS, context)
 
         # Execute ogr2ogr only in case the shape is Valid or no shape was provided
         shapec_qgs = QgsVectorLayer(shapec, 'test_valid', 'ogr')
@@ -131,24 +165,52 @@ class PostGISSchema2Shapefile(QgsProcessingAlgorithm):
         else:
             raise QgsProcessingException("Invalid shape")
 
-        # Text for ogr2ogr
-        if shapec == '':
-            target_ogr = ('ogr2ogr -fieldTypeToString IntegerList,Integer64List,RealList,StringList '
-                          '-lco ENCODING=UTF-8 -f "ESRI Shapefile" {} -overwrite ').format(shapef)
-        else:
-            target_ogr = ('ogr2ogr -fieldTypeToString IntegerList,Integer64List,RealList,StringList '
-                          '-lco ENCODING=UTF-8 -f "ESRI Shapefile" {} -clipsrc {} -overwrite ').format(shapef, shapec)    
-            
-        source_ogr = 'PG:"host={} dbname={} schemas={} port={} user={} password={}" '.format(uri.host(), uri.database(), 
-                                                                                      schema, uri.port(), uri.username(), 
-                                                                                      uri.password())
-        string_ogr = target_ogr + source_ogr
-        feedback.pushInfo('Text for ogr2ogr = ' + string_ogr)
+        # Schema tables, read once for the whole run
+        catalog = SchemaCatalog(uri, schema)
+
+        # Selected tables, largest first, given explicitly to every export mode
+        tables = selected_tables(self, parameters, context, catalog, feedback)
+        if not tables:
+            return {'Result': 'Exported'}
+
+        # Clip on the server: one query per table
+        queries = None
+        if clip_on_server and shapec != '':
+            feedback.pushInfo('Clipping on the database server')
+            queries = server_clip_queries(catalog, shapec_qgs)
+            shapec = ''
+
+        # Options for ogr2ogr
+        options = export_options('ESRI Shapefile', clip=shapec,
+                                 extra=['-fieldTypeToString', 'IntegerList,Integer64List,RealList,StringList',
+                                        '-lco', 'ENCODING=UTF-8'])
+        feedback.pushInfo('Options for ogr2ogr = ' + ' '.join(options))
+        
+        engine = ExportEngine(uri, schema, feedback, queries)
+
+        # Parallel mode: each table to its own shapefile, one table per worker at a time
+        if workers > 1:
+            feedback.pushInfo('Exporting with {} parallel workers'.format(workers))
+            try:
+                errors = export_tables_concurrently(engine, tables, lambda table: os.path.join(shapef, table + '.shp'),
+                                                    options, workers, weights=catalog.sizes())
+            finally:
+                engine.close()
+
+            if feedback.isCanceled():
+                return {'Result': 'Canceled'}
+            if errors:
+                feedback.reportError('{} of {} tables were not exported: {}'.format(len(errors), len(tables), ', '.join(sorted(errors))))
+                return {'Result': 'Exported with errors', 'Failed tables': sorted(errors)}
+            return {'Result': 'Exported'}
         
         # Export schema to shapefile
         try:
-            process = subprocess.run(string_ogr, shell=True, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        except subprocess.CalledProcessError as e:
-            raise QgsProcessingException(str(e.stderr.decode('utf-8')))
+            exported = engine.export(shapef, options, tables)
+        finally:
+            engine.close()
+
+        if not exported:
+            return {'Result': 'Canceled'}
 
-        return {'Result': 'Exported'}  
\ No newline at end of file
+        return {'Result': 'Exported'}
\ No newline at end of file
@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+
+"""
+***************************************************************************
+*                                                                         *
+*   This program is free software; you can redistribute it and/or modify  *
+*   it under the terms of the GNU General Public License as published by  *
+*   the Free Software Foundation; either version 2 of the License, or     *
+*   (at your option) any later version.                                   *
+*                                                                         *
+***************************************************************************
+"""
+
+
+from qgis.PyQt.QtCore import QCoreApplication
+from qgis.core import (QgsProcessingException,
+                       QgsProcessingAlgorithm,
+                       QgsProcessingParameterString,
+                       QgsProcessingParameterFileDestination,
+                       QgsProcessingParameterNumber,
+                       Qgis,
+                       QgsProviderRegistry,
+                       QgsDataSourceUri)
+
+qgs_version = Qgis.QGIS_VERSION_INT
+if qgs_version < 31400:
+    from processing.tools import postgis
+else:
+    from qgis.core import QgsProcessingParameterProviderConnection
+    from qgis.core import QgsProcessingParameterDatabaseSchema
+
+import csv
+
+from .schema_diff import CHANGE_KINDS, diff_schemas
+from .schema_introspection import SchemaCatalog, split_patterns
+
+
+class PostGISSchemaDiff(QgsProcessingAlgorithm):
+    # Constants used to refer to parameters
+
+    DATABASE = 'DATABASE'
+    BASE_SCHEMA = 'BASE_SCHEMA'
+    SCHEMA = 'SCHEMA'
+    KEY_COLUMNS = 'KEY_COLUMNS'
+    INCLUDE_TABLES = 'INCLUDE_TABLES'
+    EXCLUDE_TABLES = 'EXCLUDE_TABLES'
+    WORKERS = 'WORKERS'
+    OUTPUT = 'OUTPUT'
+
+    def tr(self, string):
+        """
+        Returns a translatable string with the self.tr() function.
+        """
+        return QCoreApplication.translate("Publi Base: PostGISSchemaDiff", string)
+
+    def createInstance(self):
+        return PostGISSchemaDiff()
+
+    def name(self):
+        return 'postgis_schema_diff'
+
+    def displayName(self):
+        return self.tr('Reambulation: PostGIS Schema Diff')
+
+    def group(self):
+        return self.tr('Reambulation')
+
+    def groupId(self):
+        return 'reambulation'
+
+    def shortHelpString(self):
+        return self.tr("Compute, inside PostGIS, the features inserted, updated and deleted in a "
+                       "reambulation schema relative to the base schema.\n\n"
+                       "The tables found in both schemas are compared row by row on the key columns "
+                       "(by default the primary key of each table), using a hash of the other columns, "
+                       "geometry included. The tables are compared in parallel, largest first, and only "
+                       "the keys of the changed rows are sent to QGIS.\n\n"
+                       "The change set is written to a CSV file with the table, the kind of change and "
+                       "the key of each changed row.")
+
+    def initAlgorithm(self, config=None):
+        # Database Connection
+        if qgs_version < 31400:
+            db_param = QgsProcessingParameterString(
+                self.DATABASE,
+                self.tr('Database Connection'))
+            db_param.setMetadata({
+                'widget_wrapper': {
+                    'class': 'processing.gui.wrappers_postgis.ConnectionWidgetWrapper'}})
+        else:
+            db_param = QgsProcessingParameterProviderConnection(
+                self.DATABASE,
+                self.tr('Database Connection'),
+                'postgres')
+
+        self.addParameter(db_param)
+
+        # Base and reambulation schemas
+        for name, description, default in [(self.BASE_SCHEMA, self.tr('Base schema'), 'bc250_base'),
+                                           (self.SCHEMA, self.tr('Reambulation schema'), 'bc250_reamb')]:
+            if qgs_version < 31400:
+                schema_param = QgsProcessingParameterString(name, description, default)
+                schema_param.setMetadata({
+                    'widget_wrapper': {
+                        'class': 'processing.gui.wrappers_postgis.SchemaWidgetWrapper',
+                        'connection_param': self.DATABASE}})
+            else:
+                schema_param = QgsProcessingParameterDatabaseSchema(
+                    name,
+                    description,
+                    defaultValue=default,
+                    connectionParameterName=self.DATABASE)
+
+            self.addParameter(schema_param)
+
+        # Key of the rows
+        self.addParameter(QgsProcessingParameterString(self.KEY_COLUMNS, self.tr('Key columns, comma separated (default: primary key)'),
+                                                       '', False, True))
+
+        # Table selection
+        self.addParameter(QgsProcessingParameterString(self.INCLUDE_TABLES, self.tr('Tables to compare (comma separated patterns, e.g. hid_*, tra_*)'),
+                                                       '', False, True))
+        self.addParameter(QgsProcessingParameterString(self.EXCLUDE_TABLES, self.tr('Tables not to compare (comma separated patterns)'),
+                                                       '', False, True))
+
+        # Number of tables compared at the same time
+        self.addParameter(QgsProcessingParameterNumber(self.WORKERS, self.tr('Parallel workers'),
+                                                       QgsProcessingParameterNumber.Integer, 1, False, 1))
+
+        # Change set
+        self.addParameter(QgsProcessingParameterFileDestination(self.OUTPUT, self.tr('Change set'), 'CSV files (*.csv)'))
+
+    def processAlgorithm(self, parameters, context, feedback):
+        # Retrieving parameters
+        if qgs_version < 31400:
+            connection_name = self.parameterAsString(parameters, self.DATABASE, context)
+            db = postgis.GeoDB.from_name(connection_name)
+            uri = db.uri
+
+            base_schema = self.parameterAsString(parameters, self.BASE_SCHEMA, context)
+            schema = self.parameterAsString(parameters, self.SCHEMA, context)
+        else:
+            connection_name = self.parameterAsConnectionName(parameters, self.DATABASE, context)
+            md = QgsProviderRegistry.instance().providerMetadata('postgres')
+            conn = md.createConnection(connection_name)
+            uri = QgsDataSourceUri(conn.uri())
+
+            base_schema = self.parameterAsSchema(parameters, self.BASE_SCHEMA, context)
+            schema = self.parameterAsSchema(parameters, self.SCHEMA, context)
+
+        key_columns = split_patterns(self.parameterAsString(parameters, self.KEY_COLUMNS, context))
+        include_tables = self.parameterAsString(parameters, self.INCLUDE_TABLES, context)
+        exclude_tables = self.parameterAsString(parameters, self.EXCLUDE_TABLES, context)
+        workers = self.parameterAsInt(parameters, self.WORKERS, context)
+        output = self.parameterAsFileOutput(parameters, self.OUTPUT, context)
+
+        if base_schema == schema:
+            raise QgsProcessingException('The base and the reambulation schemas must be different')
+
+        # Both catalogs, read once for the whole run
+        base_catalog = SchemaCatalog(uri, base_schema)
+        catalog = SchemaCatalog(uri, schema)
+
+        base_tables = base_catalog.select_tables(include_tables, exclude_tables)
+        tables = catalog.select_tables(include_tables, exclude_tables)
+        only_base = [table for table in base_tables if table not in tables]
+        only_reamb = [table for table in tables if table not in base_tables]
+        if only_base:
+            feedback.pushInfo('Tables only in {} = {}'.format(base_schema, only_base))
+        if only_reamb:
+            feedback.pushInfo('Tables only in {} = {}'.format(schema, only_reamb))
+        tables = [table for table in tables if table in base_tables]
+        feedback.pushInfo('Tables compared = {}'.format(len(tables)))
+        feedback.pushInfo('')
+
+        changes, errors = diff_schemas(base_catalog, catalog, tables, workers, feedback, key_columns)
+        if feedback.isCanceled():
+            return {'Result': 'Canceled'}
+
+        # Change set, one row per changed feature
+        totals = {kind: 0 for kind in CHANGE_KINDS}
+        with open(output, 'w', newline='', encoding='utf-8') as f:
+            writer = csv.writer(f)
+            writer.writerow(['table', 'change', 'key'])
+            for table in sorted(changes):
+                for kind in CHANGE_KINDS:
+                    totals[kind] += len(changes[table][kind])
+                    writer.writerows([table, kind, key] for key in changes[table][kind])
+
+        feedback.pushInfo('')
+        feedback.pushInfo('Total: ' + ', '.join('{} {}'.format(totals[kind], kind) for kind in CHANGE_KINDS))
+
+        results = {'Result': 'Diff computed', self.OUTPUT: output}
+        results.update({kind.capitalize(): totals[kind] for kind in CHANGE_KINDS})
+        if errors:
+            results['Result'] = 'Diff computed with errors'
+            results['Failed tables'] = sorted(errors)
+        return results
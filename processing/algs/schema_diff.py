@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+
+"""
+***************************************************************************
+*                                                                         *
+*   This program is free software; you can redistribute it and/or modify  *
+*   it under the terms of the GNU General Public License as published by  *
+*   the Free Software Foundation; either version 2 of the License, or     *
+*   (at your option) any later version.                                   *
+*                                                                         *
+***************************************************************************
+"""
+
+from .concurrency import run_concurrently
+from .schema_introspection import pg_connection_pool, quote_ident, quote_table
+
+
+# Kinds of change of a row, from the base schema to the compared schema
+CHANGE_KINDS = ('inserted', 'updated', 'deleted')
+
+
+
+def key_expression(alias, key):
+    '''Text of the key columns of a row, a single value even for composite keys.'''
+    if len(key) == 1:
+        return '{}.{}::text'.format(alias, quote_ident(key[0]))
+    return 'ROW({})::text'.format(', '.join('{}.{}'.format(alias, quote_ident(column)) for column in key))
+
+
+def diff_query(base_schema, schema, table, key, columns):
+    '''Query of the (change kind, key) of the rows of table that differ between
+       the base schema and the compared schema.
+
+       The rows are matched on the key columns and compared by the md5 of the
+       text of their other columns, the geometries as their hexadecimal EWKB,
+       so only the keys and the hashes are joined and nothing but the changed
+       keys leaves the server.'''
+    row_hash = 'md5(ROW({})::text)'.format(', '.join('t.' + quote_ident(column) for column in columns)) if columns else "''"
+    side = 'SELECT {} AS k, {} AS h FROM {} t'
+    return ("SELECT CASE WHEN b.k IS NULL THEN 'inserted' WHEN r.k IS NULL THEN 'deleted' ELSE 'updated' END, "
+            "COALESCE(r.k, b.k) "
+            "FROM ({}) b FULL JOIN ({}) r ON r.k = b.k "
+            "WHERE b.k IS NULL OR r.k IS NULL OR b.h <> r.h "
+            "ORDER BY 2").format(side.format(key_expression('t', key), row_hash, quote_table(base_schema, table)),
+                                 side.format(key_expression('t', key), row_hash, quote_table(schema, table)))
+
+
+def diff_columns(base_info, info, key=None):
+    '''(key columns, compared columns) of a table present in both schemas.
+
+       The key is given or the primary key of the compared table, and the
+       compared columns are the other columns found in both tables. Raise
+       ValueError if there is no key or a key column is missing in one of
+       the tables.'''
+    key = key or info.primary_key
+    if not key:
+        raise ValueError('Table {} has no primary key'.format(info.name))
+    missing = [column for column in key if column not in info.columns or column not in base_info.columns]
+    if missing:
+        raise ValueError('Key column {} not found in both tables {}'.format(', '.join(missing), info.name))
+    columns = [column for column in info.columns if column in base_info.columns and column not in key]
+    return key, columns
+
+
+def diff_schemas(base_catalog, catalog, tables, workers, feedback, key=None, progress=(0, 100)):
+    '''Change set {table: {change kind: [keys]}} of tables, from the schema of
+       base_catalog to the schema of catalog, both in the same database.
+
+       Each table is compared by its own query, workers tables at a time over a
+       pool of connections, largest first. A table that fails doesn't stop the
+       others and, when the feedback is canceled, the pending tables aren't
+       compared. Return (change set, {table: error message}).'''
+    base_tables = {table.name: table for table in base_catalog.tables()}
+    infos = {table.name: table for table in catalog.tables()}
+    sizes = catalog.sizes()
+    tables = sorted(tables, key=lambda table: sizes.get(table, 0), reverse=True)
+
+    pool = pg_connection_pool(catalog.uri, workers)
+
+    def compare(table):
+        table_key, columns = diff_columns(base_tables[table], infos[table], key)
+        con = pool.getconn()
+        try:
+            with con:
+                cur = con.cursor()
+                cur.execute(diff_query(base_catalog.schema, catalog.schema, table, table_key, columns))
+                rows = cur.fetchall()
+                cur.close()
+        finally:
+            pool.putconn(con)
+        table_changes = {kind: [] for kind in CHANGE_KINDS}
+        for kind, row_key in rows:
+            table_changes[kind].append(row_key)
+        return table_changes
+
+    def done(table, table_changes, seconds):
+        feedback.pushInfo('{}: {} in {:.1f} s'.format(table, ', '.join(
+            '{} {}'.format(len(table_changes[kind]), kind) for kind in CHANGE_KINDS), seconds))
+
+    def failed(table, e):
+        feedback.reportError('Table {} not compared: {}'.format(table, e))
+
+    try:
+        return run_concurrently(tables, compare, workers, feedback, progress, None, done, failed)
+    finally:
+        pool.closeall()
@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+
+"""
+***************************************************************************
+*                                                                         *
+*   This program is free software; you can redistribute it and/or modify  *
+*   it under the terms of the GNU General Public License as published by  *
+*   the Free Software Foundation; either version 2 of the License, or     *
+*   (at your option) any later version.                                   *
+*                                                                         *
+***************************************************************************
+"""
+
+from collections import namedtuple
+from fnmatch import fnmatchcase
+
+import psycopg2
+from psycopg2.pool import ThreadedConnectionPool
+
+
+# relkind of the base tables (ordinary and partitioned) and of every relation listed by information_schema.tables
+BASE_TABLE_KINDS = ('r', 'p')
+ALL_TABLE_KINDS = ('r', 'p', 'v', 'm', 'f')
+
+# Tables kept by the plugin in the schemas, left out of the catalog
+INTERNAL_TABLES = ('publibase_import_journal', 'publibase_suspended_objects', 'publibase_imported_features')
+
+# Description of a relation of the schema
+TableInfo = namedtuple('TableInfo', ['name', 'kind', 'row_estimate', 'size', 'columns', 'column_types',
+                                     'array_columns', 'geometry_column', 'geometry_type', 'srid',
+                                     'primary_key', 'relfilenode', 'live_rows', 'modifications'])
+
+# One query for the whole schema: relations, columns, geometry columns, array columns,
+# primary keys, row estimates, sizes and modification counters
+# The columns of pg_class are grouped explicitly: system catalogs have no primary key before PostgreSQL 14
+CATALOG_QUERY = """
+SELECT c.relname, c.relkind, c.reltuples::bigint, pg_total_relation_size(c.oid),
+       COALESCE(array_agg(a.attname ORDER BY a.attnum) FILTER (WHERE a.attnum IS NOT NULL), '{}'),
+       COALESCE(array_agg(format_type(a.atttypid, a.atttypmod) ORDER BY a.attnum) FILTER (WHERE a.attnum IS NOT NULL), '{}'),
+       COALESCE(array_agg(a.attname ORDER BY a.attnum) FILTER (WHERE t.typcategory = 'A'), '{}'),
+       array_agg(a.attname ORDER BY a.attnum) FILTER (WHERE t.typname = 'geometry'),
+       array_agg(postgis_typmod_type(a.atttypmod) ORDER BY a.attnum) FILTER (WHERE t.typname = 'geometry'),
+       array_agg(postgis_typmod_srid(a.atttypmod) ORDER BY a.attnum) FILTER (WHERE t.typname = 'geometry'),
+       ARRAY(SELECT pa.attname FROM pg_index i JOIN pg_attribute pa ON pa.attrelid = i.indrelid AND pa.attnum = ANY(i.indkey)
+             WHERE i.indrelid = c.oid AND i.indisprimary),
+       c.relfilenode, s.n_live_tup, s.n_tup_ins, s.n_tup_upd, s.n_tup_del
+FROM pg_catalog.pg_class c
+JOIN pg_catalog.pg_namespace n ON n.oid = c.relnamespace
+LEFT JOIN pg_catalog.pg_attribute a ON a.attrelid = c.oid AND a.attnum > 0 AND NOT a.attisdropped
+LEFT JOIN pg_catalog.pg_type t ON t.oid = a.atttypid
+LEFT JOIN pg_catalog.pg_stat_user_tables s ON s.relid = c.oid
+WHERE n.nspname = %s AND c.relkind IN ('r', 'p', 'v', 'm', 'f')
+GROUP BY c.oid, c.relname, c.relkind, c.reltuples, c.relfilenode, s.n_live_tup, s.n_tup_ins, s.n_tup_upd, s.n_tup_del
+ORDER BY pg_total_relation_size(c.oid) DESC, c.relname
+"""
+
+
+
+def quote_ident(name):
+    '''Quote a PostgreSQL identifier.'''
+    return '"' + name.replace('"', '""') + '"'
+
+
+def quote_table(schema, name, parameters=False):
+    '''Quote the schema qualified name of a table. In queries with parameters,
+       % (the psycopg2 placeholder) is doubled.'''
+    table = '{}.{}'.format(quote_ident(schema), quote_ident(name))
+    return table.replace('%', '%%') if parameters else table
+
+
+def split_patterns(text):
+    '''List of the comma separated patterns of text.'''
+    return [pattern.strip() for pattern in (text or '').split(',') if pattern.strip()]
+
+
+def pg_connect(uri):
+    '''psycopg2 connection to the database of the uri.'''
+    return psycopg2.connect(user = uri.username(), password = uri.password(),
+                            host = uri.host(), port = uri.port(), database = uri.database())
+
+
+def pg_connect_info(uri):
+    '''psycopg2 connection with the connection info of a layer uri, its authentication configuration expanded.'''
+    return psycopg2.connect(uri.connectionInfo(True))
+
+
+def pg_connection_pool(uri, size):
+    '''Pool of at most size psycopg2 connections to the database of the uri, shared by threads.'''
+    return ThreadedConnectionPool(1, size, user = uri.username(), password = uri.password(),
+                                  host = uri.host(), port = uri.port(), database = uri.database())
+
+
+class SchemaCatalog:
+    '''Catalog of a PostGIS schema, read with a single pg_catalog query.
+
+       The query runs the first time the catalog is used and the result is
+       kept for the lifetime of the object, so an algorithm creates one
+       catalog per run and hands it to every step that needs it.'''
+
+    def __init__(self, uri, schema):
+        self.uri = uri
+        self.schema = schema
+        self._tables = None
+        self._non_empty = dict()
+
+    def _load(self):
+        con = pg_connect(self.uri)
+        try:
+            with con:
+                cur = con.cursor()
+                cur.execute(CATALOG_QUERY, (self.schema,))
+                rows = cur.fetchall()
+                cur.close()
+        finally:
+            con.close()
+
+        tables = []
+        for (name, kind, row_estimate, size, columns, column_types, array_columns, geometry_columns,
+             geometry_types, srids, primary_key, relfilenode, live_rows, inserted, updated, deleted) in rows:
+            if name in INTERNAL_TABLES:
+                continue
+            # Only the first geometry column describes the geometry of the table
+            geometry = (geometry_columns[0], geometry_types[0], srids[0]) if geometry_columns else (None, None, None)
+            modifications = (inserted, updated, deleted) if inserted is not None else None
+            tables.append(TableInfo(name, kind, row_estimate, size, list(columns), list(column_types), list(array_columns),
+                                    geometry[0], geometry[1], geometry[2], list(primary_key), relfilenode, live_rows,
+                                    modifications))
+        return tables
+
+    def tables(self, kinds=BASE_TABLE_KINDS):
+        '''Relations of the schema of the given kinds, largest first.'''
+        if self._tables is None:
+            self._tables = self._load()
+        return [table for table in self._tables if table.kind in kinds]
+
+    def table_names(self, kinds=BASE_TABLE_KINDS):
+        '''Names of the relations of the schema of the given kinds, largest first.'''
+        return [table.name for table in self.tables(kinds)]
+
+    def exportable_tables(self):
+        '''Relations of the schema exported as layers, largest first: the base
+           tables, and the views, materialized views and foreign tables with a
+           geometry column, as listed by the OGR PostgreSQL driver.'''
+        return [table for table in self.tables(ALL_TABLE_KINDS)
+                if table.kind in BASE_TABLE_KINDS or table.geometry_column is not None]
+
+    def table(self, name):
+        '''Description of a relation of the schema, None if it doesn't exist.'''
+        for table in self.tables(ALL_TABLE_KINDS):
+            if table.name == name:
+                return table
+        return None
+
+    def sizes(self):
+        '''{table: size in bytes} of the relations of the schema.'''
+        return {table.name: table.size for table in self.tables(ALL_TABLE_KINDS)}
+
+    def empty_tables(self, names):
+        '''Empty tables among the relations names.
+
+           A positive reltuples tells that a table has rows without reading it.
+           The other relations (empty at the last ANALYZE, never analyzed, or
+           views) are probed with EXISTS, all of them in a single query.'''
+        estimates = {table.name: table.row_estimate for table in self.tables(ALL_TABLE_KINDS)}
+        for name in names:
+            if name not in self._non_empty and estimates.get(name, 0) > 0:
+                self._non_empty[name] = True
+
+        probe = [name for name in names if name not in self._non_empty]
+        if probe:
+            query = ' UNION ALL '.join('SELECT %s, EXISTS (SELECT 1 FROM {})'.format(quote_table(self.schema, name, True))
+                                       for name in probe)
+            con = pg_connect(self.uri)
+            try:
+                with con:
+                    cur = con.cursor()
+                    cur.execute(query, probe)
+                    self._non_empty.update(cur.fetchall())
+                    cur.close()
+            finally:
+                con.close()
+
+        return [name for name in names if not self._non_empty[name]]
+
+    def select_tables(self, include='', exclude='', skip_empty=False, exportable=False):
+        '''Names of the base tables (the exportable relations, with exportable),
+           largest first, matching one of the include patterns (all, if there
+           are none) and none of the exclude patterns.
+
+           Patterns are comma separated shell wildcards, for example
+           "hid_*, tra_*". With skip_empty, the empty tables are left out.'''
+        include = split_patterns(include)
+        exclude = split_patterns(exclude)
+        candidates = [table.name for table in self.exportable_tables()] if exportable else self.table_names()
+        names = [name for name in candidates
+                 if (not include or any(fnmatchcase(name, pattern) for pattern in include))
+                 and not any(fnmatchcase(name, pattern) for pattern in exclude)]
+        if skip_empty:
+            empty = self.empty_tables(names)
+            names = [name for name in names if name not in empty]
+        return names
+
+    def refresh(self):
+        '''Forget the cached catalog, so the next use reads it again.'''
+        self._tables = None
+        self._non_empty = dict()
@@ -29,7 +29,8 @@ else:
     from qgis.core import QgsProcessingParameterDatabaseSchema
 
 import requests
-import psycopg2
+
+from ..algs.schema_introspection import SchemaCatalog, ALL_TABLE_KINDS
 
 class PostGISSchema2GeoserverCCAR(QgsProcessingAlgorithm):
     # Constants used to refer to parameters
@@ -163,27 +164,9 @@ class PostGISSchema2GeoserverCCAR(QgsProcessingAlgorithm):
         feedback.pushInfo('')
         
         
-        # URI and connection
-        uri = db.uri
-        
-        con = psycopg2.connect(user = uri.username(), password = uri.password(), 
-                                      host = uri.host(), port = uri.port(), database = uri.database())
-        
-        feedback.pushInfo('')
-        feedback.pushInfo('Connection = ' + str(con) +'\n')
-        
-
-        with con:
-            select_schema_tables = "SELECT table_name FROM information_schema.tables " \
-                                   "WHERE table_schema = '{}'".format(schema)
-                                   
-            cur = con.cursor()
-            
-            cur.execute(select_schema_tables)
-            
-            rows = cur.fetchall()
-
-            schema_tables = [table[0] for table in rows]
+        # Tables of the schema, from the schema catalog
+        catalog = SchemaCatalog(uri, schema)
+        schema_tables = catalog.table_names(ALL_TABLE_KINDS)
             
         
         feedback.pushInfo('Schema Tables = ' + str(schema_tables) + '\n')
@@ -29,6 +29,7 @@ from .algs.postgis_schema2geopackage_reambulation import PostGISSchema2Geopackag
 from .algs.geopackage2postgis_schema_reambulation import Geopackage2PostGISSchemaReambulation
 from .algs.postgis_schema2shapefile import PostGISSchema2Shapefile
 from .algs.AppendFeaturesToLayer import AppendFeaturesToLayer
+from .algs.postgis_schema_diff import PostGISSchemaDiff
 
 # Geoserver algorithms
 from .geoserver_algs.postgis_schema2geoserver_ccar import PostGISSchema2GeoserverCCAR
@@ -107,8 +108,8 @@ class LoadAlgorithmProvider(QgsProcessingProvider):
         cleared before calling this method.
         """
         for alg in [PostGISSchema2Geopackage(), PostGISSchema2Shapefile(), PostGISSchema2GeopackageReambulation(),
-                    Geopackage2PostGISSchemaReambulation(), AppendFeaturesToLayer(), PostGISSchema2GeoserverCCAR(),
-                    PostGISSchema2GeoserverCCARNotAdvertised(), PostGIS2Geoserver(), AdvertiseStoreLayers(),
+                    Geopackage2PostGISSchemaReambulation(), AppendFeaturesToLayer(), PostGISSchemaDiff(),
+                    PostGISSchema2GeoserverCCAR(), PostGISSchema2GeoserverCCARNotAdvertised(), PostGIS2Geoserver(), AdvertiseStoreLayers(),
                     DeAdvertiseStoreLayers(), ReplaceStringInNameAndTitleOfStoreLayers(), CreateWorkspace(),
                     DownloadStylesFromWorkspace(), UploadStylesToWorkspace(), AssociateLayersToWorkspaceStyles(),
                     FindLayersWithoutWorkspaceStyle(), DeleteStylesFromWorkspace(), SaveProjectVectorStyles()]: